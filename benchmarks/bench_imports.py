@@ -0,0 +1,86 @@
+'''
+Created on 19.10.2026
+
+Measures the import time of the helper modules - each in a fresh interpreter (python -X importtime).
+Fails (exit code 1) if a module exceeds its budget or imports a module that should only be loaded on first use.
+
+python benchmarks/bench_imports.py [--repeat 5] [--output imports.json]
+'''
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# module -> import time budget in milliseconds (cumulative, including the imported standard modules)
+BUDGETS = {
+    'FileHelper': 50,
+    'ExecHelper': 50,
+    'AsyncExec': 30,
+    'AsyncIterator': 40,
+    'PyxlHelper': 60,
+    'ReMatcher': 30,
+    'SaxHelper': 30,
+    'git.GitHelper': 70,
+    'git.ZipChangedFiles': 120,
+}
+
+# modules that must not be loaded by a plain import of the helper
+LAZY = ['openpyxl', 'numpy', 'multiprocessing', 'concurrent.futures', 'tempfile']
+EXPECTED = {'git.ZipChangedFiles': ['concurrent.futures', 'tempfile']}  # needed for every zip anyway
+
+
+def importTime(module):
+    ''' cumulative import time of the module in ms and the loaded modules '''
+    code = "import sys, %s; print(' '.join(sys.modules))" % module
+    env = dict(os.environ, PYTHONPATH=SRC)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000.0, set(proc.stdout.split())
+    raise RuntimeError("no import time found for " + module)
+
+
+def run(repeat=5):
+    results = []
+    for module, budget in sorted(BUDGETS.items()):
+        times = []
+        loaded = set()
+        for _ in range(repeat):
+            ms, loaded = importTime(module)
+            times.append(ms)
+        eager = [m for m in LAZY if m in loaded and m not in EXPECTED.get(module, [])]
+        results.append({'benchmark': 'import', 'name': module, 'unit': 'ms', 'min': min(times),
+                        'median': sorted(times)[len(times) // 2], 'budget': budget, 'eager': eager,
+                        'ok': min(times) <= budget and not eager})
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import time benchmark of the helper modules')
+    parser.add_argument('-r', '--repeat', help='number of measurements per module', default=5, type=int)
+    parser.add_argument('-o', '--output', help='JSON output file. Default: stdout', default=None)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    out = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+    failed = [r for r in results if not r['ok']]
+    for r in failed:
+        sys.stderr.write("%s: %.1f ms (budget %d ms) eager imports: %s\n" % (r['name'], r['min'], r['budget'], r['eager']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+'''
+Created on 19.10.2026
+
+Offline benchmark suite of the helper modules. All input data is generated - no network access is needed.
+
+python benchmarks/run_benchmarks.py                        # run all benchmarks, print JSON
+python benchmarks/run_benchmarks.py -o current.json        # store the results
+python benchmarks/run_benchmarks.py -c baseline.json       # compare with a previous run (exit code 1 on regressions)
+python benchmarks/run_benchmarks.py -k sax -k mergeDiff    # only benchmarks containing one of the names
+python benchmarks/run_benchmarks.py --quick                # smaller data sizes for a fast check (same as -s 0.1)
+
+Each result has the benchmark name, a unit and a value where a smaller value is better (the minimum run time in seconds).
+Throughput values (e.g. lines per second) are reported additionally but are not used for the comparison.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from AsyncExec import AsyncExec
+from AsyncIterator import AsyncIterator
+import ExecHelper
+import FileHelper
+from ReMatcher import MultiReMatcher, ReMatcher
+from SaxHelper import SaxHelper, iterparse
+from git.GitHelper import Git
+
+BENCHMARKS = []
+
+
+def benchmark(fun):
+    ''' registers the benchmark function - it receives the size factor and returns a list of results '''
+    BENCHMARKS.append(fun)
+    return fun
+
+
+def measure(fun, repeat=3):
+    ''' minimum and median of the run time of fun in seconds '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def result(name, seconds, count=None, countUnit=None, **extra):
+    best, median = seconds
+    res = {'name': name, 'unit': 's', 'value': best, 'median': median}
+    if count:
+        res['throughput'] = count / best
+        res['throughputUnit'] = countUnit + '/s'
+    res.update(extra)
+    return res
+
+
+def fib(i):
+    return i if i <= 1 else fib(i - 2) + fib(i - 1)
+
+
+def tiny(i):
+    return i + 1
+
+
+@benchmark
+def asyncExec(size):
+    results = []
+    n = int(20000 * size)
+    for name, fun, param, count in [('tiny', tiny, 1, n), ('cpu', fib, 20, max(4, int(40 * size)))]:
+        params = [param] * count
+
+        def runAsyncExec():
+            list(AsyncExec(4).fun(fun).map(params))
+
+        def runFutures():
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(fun, params))
+
+        def runAsyncIterator():
+            ai = AsyncIterator(fun, params, numThreads=4)
+            ai.execute()
+
+        results.append(result('AsyncExec.map.' + name, measure(runAsyncExec), count, 'calls'))
+        results.append(result('AsyncIterator.' + name, measure(runAsyncIterator), count, 'calls'))
+        results.append(result('ThreadPoolExecutor.map.' + name, measure(runFutures), count, 'calls'))
+
+    # latency: time from adding a single call until its result is available
+    def latency():
+        for _ in range(100):
+            AsyncExec(1, add_results=True).add(tiny, 1).join()
+    best, median = measure(latency)
+    results.append(result('AsyncExec.latency', (best / 100, median / 100)))
+    return results
+
+
+@benchmark
+def readLines(size):
+    n = int(200000 * size)
+    code = "import sys\nfor i in range(%d): sys.stdout.write('line %%d with some synthetic output text\\n' %% i)" % n
+    cmd = [sys.executable, '-c', code]
+
+    def run():
+        for _ in ExecHelper.readLines(cmd):
+            pass
+    return [result('ExecHelper.readLines', measure(run), n, 'lines')]
+
+
+@benchmark
+def getLines(size, tmpdir=None):
+    n = int(500000 * size)
+    filename = os.path.join(tmpdir, 'lines.txt')
+    with open(filename, 'w') as f:
+        for i in range(n):
+            f.write('    line %d with some text to strip    \n' % i)
+
+    def run():
+        for _ in FileHelper.getLines(filename):
+            pass
+    return [result('FileHelper.getLines', measure(run), n, 'lines')]
+
+
+def _hunk(rnd, n):
+    words = ['int', 'value', 'return', 'if', '(', ')', '{', '}', 'foo', 'bar', '=', '+', 'count', ';']
+    return [(i, ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 12)))) for i in range(n)]
+
+
+@benchmark
+def mergeDiff(size):
+    rnd = random.Random(42)
+    results = []
+    for removed, added in [(50, 60), (int(200 * size), int(1000 * size))]:
+        linesRemoved = _hunk(rnd, removed)
+        linesAdded = _hunk(rnd, added)
+
+        def run():
+            list(Git.mergeDiff(list(linesRemoved), list(linesAdded)))
+        results.append(result('Git.mergeDiff.%dx%d' % (removed, added), measure(run), removed + added, 'lines'))
+    return results
+
+
+@benchmark
+def multiReMatcher(size):
+    patterns = [r'E%03d: component (\w+) failed with code (\d+)' % i for i in range(150)] + [r'\s+$']
+    n = int(20000 * size)
+    lines = ['INFO: component worker%d started after %d ms' % (i % 17, i) for i in range(n)]
+    for i in range(0, n, 100):
+        lines[i] = 'E%03d: component worker%d failed with code %d' % (i % 150, i % 17, i)
+    multi = MultiReMatcher(patterns)
+    single = [ReMatcher(pattern) for pattern in patterns]
+
+    def runMulti():
+        for line in lines:
+            multi.search(line)
+
+    def runLoop():
+        for line in lines:
+            for matcher in single:
+                if matcher.regex.search(line):
+                    break
+    return [result('MultiReMatcher.search', measure(runMulti), n, 'lines'),
+            result('ReMatcher.loop.search', measure(runLoop), n, 'lines')]
+
+
+@benchmark
+def sax(size, tmpdir=None):
+    n = int(50000 * size)
+    filename = os.path.join(tmpdir, 'data.xml')
+    with open(filename, 'w') as f:
+        f.write('<catalog>\n')
+        for i in range(n):
+            f.write('<book id="%d"><title>Title %d</title><author>Author</author><text>%s</text></book>\n' % (i, i, 'lorem ipsum ' * 20))
+        f.write('</catalog>\n')
+
+    class Titles(SaxHelper):
+        def __init__(self, filename):
+            SaxHelper.__init__(self, filename)
+            self.titles = []
+
+        def endElement(self, name):
+            if name == 'title':
+                self.titles.append(self.currentContent)
+
+    def runHandler():
+        with Titles(filename):
+            pass
+
+    def runSubscription():
+        for _ in iterparse(filename, ['/catalog/book/title']):
+            pass
+    return [result('SaxHelper.handler', measure(runHandler), n, 'elements'),
+            result('SaxHelper.iterparse', measure(runSubscription), n, 'elements')]
+
+
+@benchmark
+def pyxl(size, tmpdir=None):
+    import PyxlHelper
+    if not PyxlHelper.pyxl_enabled:
+        return []
+    from PyxlHelper import PyxlWorkbook
+    n = int(20000 * size)
+    rows = [[i, 'name %d' % i, i * 0.5, 'some longer text in the row'] for i in range(n)]
+    filename = os.path.join(tmpdir, 'report.xlsx')
+
+    def runNormal():
+        with PyxlWorkbook(filename) as wb:
+            ws = wb.active
+            wb.appendRow(ws, ['Idx', 'Name', 'Value', 'Text'], bold=True)
+            for row in rows:
+                ws.append(row)
+
+    def runTable():
+        with PyxlWorkbook(filename, track_widths=True) as wb:
+            wb.writeTable(wb.active, rows, header=['Idx', 'Name', 'Value', 'Text'])
+
+    def runWriteOnly():
+        with PyxlWorkbook(filename, write_only=True) as wb:
+            ws = wb.createSheet('Report')
+            wb.appendRow(ws, ['Idx', 'Name', 'Value', 'Text'], bold=True)
+            for row in rows:
+                wb.appendRow(ws, row)
+    return [result('PyxlWorkbook.append+adjustColumns', measure(runNormal, 1), n, 'rows'),
+            result('PyxlWorkbook.writeTable', measure(runTable, 1), n, 'rows'),
+            result('PyxlWorkbook.writeOnly', measure(runWriteOnly, 1), n, 'rows')]
+
+
+@benchmark
+def zipChangedFiles(size, tmpdir=None):
+    if shutil.which('git') == None:
+        return []
+    from argparse import Namespace
+    from git.ZipChangedFiles import ZipChangedFiles
+    repo = os.path.join(tmpdir, 'repo')
+    os.makedirs(repo)
+
+    def git(*args):
+        subprocess.check_call(['git'] + list(args), cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    git('init', '-q')
+    git('config', 'user.email', 'bench@localhost')
+    git('config', 'user.name', 'bench')
+    n = max(10, int(200 * size))
+    rnd = random.Random(1)
+    for i in range(n):
+        with open(os.path.join(repo, 'file%d.txt' % i), 'w') as f:
+            f.write('\n'.join(line for _, line in _hunk(rnd, 2000)))
+    git('add', '.')
+    git('commit', '-q', '-m', 'initial')
+    for i in range(n):
+        with open(os.path.join(repo, 'file%d.txt' % i), 'a') as f:
+            f.write('changed\n')
+    outputfile = os.path.join(tmpdir, 'changes.zip')
+
+    def run():
+        ZipChangedFiles(Namespace(projectpath=repo, outputfile=outputfile, verbose=False)).performZip()
+
+    def runChangedFiles():
+        list(Git.changedFiles(repo))
+    return [result('ZipChangedFiles.performZip', measure(run), n, 'files'),
+            result('Git.changedFiles', measure(runChangedFiles), n, 'files')]
+
+
+@benchmark
+def imports(size):
+    import bench_imports
+    results = []
+    for res in bench_imports.run(3):
+        results.append({'name': 'import.' + res['name'], 'unit': 's', 'value': res['min'] / 1000.0,
+                        'median': res['median'] / 1000.0})
+    return results
+
+
+def run(size=1, names=None):
+    results = []
+    for bench in BENCHMARKS:
+        if names and not any(name.lower() in bench.__name__.lower() for name in names):
+            continue
+        tmpdir = tempfile.mkdtemp(prefix='bench_')
+        try:
+            if 'tmpdir' in bench.__code__.co_varnames[:bench.__code__.co_argcount]:
+                res = bench(size, tmpdir=tmpdir)
+            else:
+                res = bench(size)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        for r in res:
+            sys.stderr.write("%-40s %10.4f s\n" % (r['name'], r['value']))
+        results.extend(res)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' returns the results that are slower than the baseline by more than the tolerance (e.g. 0.2 = 20%) '''
+    before = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        old = before.get(r['name'])
+        if old != None and old['value'] > 0 and r['value'] > old['value'] * (1 + tolerance):
+            regressions.append({'name': r['name'], 'before': old['value'], 'after': r['value'],
+                                'ratio': r['value'] / old['value']})
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Benchmarks of the python helpers')
+    parser.add_argument('-o', '--output', help='JSON output file. Default: stdout', default=None)
+    parser.add_argument('-c', '--compare', help='JSON file of a previous run to compare with', default=None)
+    parser.add_argument('-t', '--tolerance', help='allowed slow down compared to the previous run', default=0.2, type=float)
+    parser.add_argument('-k', '--keyword', help='only run benchmarks containing the name', action='append', default=None)
+    parser.add_argument('--quick', help='smaller data sizes', default=False, action='store_true')
+    parser.add_argument('-s', '--size', help='size factor of the generated data', default=1.0, type=float)
+    args = parser.parse_args()
+
+    size = 0.1 if args.quick else args.size
+    results = run(size, args.keyword)
+    report = {'timestamp': datetime.now().isoformat(), 'python': sys.version.split()[0],
+              'platform': platform.platform(), 'size': size, 'results': results}
+    rc = 0
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            report['regressions'] = compare(results, json.load(f), args.tolerance)
+        for reg in report['regressions']:
+            sys.stderr.write("REGRESSION %s: %.4f s -> %.4f s (x%.2f)\n" % (reg['name'], reg['before'], reg['after'], reg['ratio']))
+        rc = 1 if report['regressions'] else 0
+    out = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,8 +5,8 @@ Created on 16.02.2020
 '''
 
 import sys
-from threading import Thread
-from multiprocessing import Condition, cpu_count
+import os
+from threading import Condition, Thread
 
 
 class AsyncExec(object):
@@ -21,14 +21,14 @@ class AsyncExec(object):
         
     # exception occurring in exc call are thrown when 'with' exits.
     
-    :param num_threads: number of threads to use in parallel
+    :param num_threads: number of threads to use in parallel. Default: number of CPUs
     :param add_results: either None or an empty list where the function call results are appended.
     '''
 
-    def __init__(self, num_threads=cpu_count(), add_results=False, result_callback=None):
+    def __init__(self, num_threads=None, add_results=False, result_callback=None):
         self.pending_calls = []
         self.workers = []
-        self.num_threads = num_threads
+        self.num_threads = num_threads or os.cpu_count() or 1
         self.exception = None
         self.running = True
         self.add_results = add_results
@@ -5,9 +5,8 @@ Created on 16.02.2020
 '''
 
 from _collections import deque
-from multiprocessing import Condition
 import sys
-from threading import Thread
+from threading import Condition, Thread
 import traceback
 import types
 
@@ -87,6 +86,8 @@ class AsyncIterator():
                 res = None
                 with self.lock:
                     if (len(self.items) == 0):
+                        if not self.feeding:
+                            break  # another thread took the last item
                         self.lock.wait()
                     if len(self.items) > 0:
                         item = self.items.popleft()
@@ -4,13 +4,10 @@ Created on 16.02.2020
 @author: Michael Schulte
 '''
 from _collections import deque
-from multiprocessing import Condition
 import os
 import subprocess
 import sys
-from tempfile import mkstemp
-from threading import Thread
-import FileHelper
+from threading import Condition, Thread
 
 
 def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, redirect=False):
@@ -37,10 +34,12 @@ def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, re
         cmd = str(cmd).strip().split()
 
     isWindows = sys.platform.startswith("win")
-    si = subprocess.STARTUPINFO()
-    # prevent cmd window to be shown 
-    si.dwFlags = subprocess.CREATE_NEW_CONSOLE | subprocess.STARTF_USESHOWWINDOW
-    si.wShowWindow = subprocess.SW_HIDE
+    si = None
+    if isWindows:
+        si = subprocess.STARTUPINFO()
+        # prevent cmd window to be shown 
+        si.dwFlags = subprocess.CREATE_NEW_CONSOLE | subprocess.STARTF_USESHOWWINDOW
+        si.wShowWindow = subprocess.SW_HIDE
 
     def oswrite(fh, txt):
         os.write(fh, txt.encode())
@@ -52,6 +51,7 @@ def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, re
     tmpfile = None
     tmpfile_redirect = None
     if redirect:
+        from tempfile import mkstemp
         fh2, tmpfile_redirect = mkstemp(suffix=".txt")
         os.close(fh2)
         cmd.append('>')
@@ -61,6 +61,7 @@ def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, re
         if isWindows:
             # piping or setting the env does not really work
             # hence: create a temporary batch file, add the correct environment and execute the batch file
+            from tempfile import mkstemp
             fh, tmpfile = mkstemp(suffix=".bat")
             oswrite(fh, "@echo off\r\n")  # suppress all output from the batch
             # set all environment variables that are in env-parameter but not in the os.environ
@@ -86,7 +87,7 @@ def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, re
 
     try:
         proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=stderr, shell=shell, env=env, startupinfo=si, text=True)
-    except WindowsError as ex:
+    except OSError as ex:
         sys.stderr.write(" ".join(cmd) + "\n")
         raise ex
 
@@ -161,8 +162,39 @@ def readLines(cmd, cwd=os.getcwd(), stderr=sys.stderr, shell=False, env=None, re
     if tmpfile:
         os.remove(tmpfile)
         if tmpfile_redirect:
+            import FileHelper  # imported here - FileHelper imports ExecHelper
             try:
                 for line in FileHelper.getLines(tmpfile_redirect):
                     yield line
             finally:
                 os.remove(tmpfile_redirect)
+
+
+def readRecords(cmd, cwd=None, sep=b'\0', encoding='utf-8', chunk_size=65536):
+    ''' Read the (stdout) output of a command split by the separator - e.g. the NUL-delimited output of "git status -z".
+    The output is read in binary chunks and the records are yielded while the command is still running.
+    Unlike readLines the records are not stripped - so file names with spaces or line breaks are kept.
+
+    :param cmd: list of command and parameters
+    :param sep: separator of the records (bytes)
+    :param encoding: encoding of the records. None: the records are returned as bytes
+    '''
+    startupinfo = None
+    if sys.platform.startswith("win"):
+        startupinfo = subprocess.STARTUPINFO()
+        # prevent cmd window to be shown 
+        startupinfo.dwFlags = subprocess.CREATE_NEW_CONSOLE | subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, startupinfo=startupinfo)
+    try:
+        rest = b''
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), b''):
+            records = (rest + chunk).split(sep)
+            rest = records.pop()
+            for record in records:
+                yield record.decode(encoding) if encoding else record
+        if rest:
+            yield rest.decode(encoding) if encoding else rest
+    finally:
+        proc.stdout.close()
+        proc.wait()
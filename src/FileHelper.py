@@ -3,11 +3,13 @@ Created on 16.02.2020
 
 @author: Michael Schulte
 '''
+from _collections import deque
+from fnmatch import fnmatch
 import os
 import stat
 import sys
+from threading import Condition, Lock, Thread
 import traceback
-import ExecHelper
 from typing import List
 
 
@@ -17,36 +19,401 @@ def getLines(filename: str, strip: bool=True):
             yield line.strip() if strip else line
 
        
-def isWritable(filename: str) -> bool:
-    return os.path.exists(filename) and (os.stat(filename).st_mode & stat.S_IWRITE) == stat.S_IWRITE
+class StatCache(object):
+    ''' Caches the stat results of files - filled with one os.scandir call per directory.
+    
+    On network file systems each single stat call is expensive. The cache reads the complete
+    directory once (on Windows the stat information is part of the directory listing)
+    and answers all further requests from memory.
+    Changes done outside of the helper functions have to be announced with invalidate.
+    
+    Example:
+    cache = StatCache()
+    for f in fileNames:
+        if not isWritable(f, cache):
+            # ...
+    forceRemoveAll(fileNames, cache)
+    '''
+
+    def __init__(self):
+        self.dirs = {}  # directory -> {file name -> DirEntry or stat_result}
+        self.lock = Lock()
+
+    @staticmethod
+    def _split(filename):
+        dirname, name = os.path.split(os.path.abspath(filename))
+        return dirname, name
+
+    def _load(self, dirname):
+        entries = {}
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    entries[entry.name] = entry
+        except OSError:
+            pass  # directory does not exist (anymore)
+        return entries
+
+    def fill(self, dirname, entries):
+        ''' Adds already scanned directory entries (e.g. from walk) to the cache '''
+        with self.lock:
+            self.dirs[os.path.abspath(dirname)] = dict((entry.name, entry) for entry in entries)
+
+    def _entries(self, dirname):
+        with self.lock:
+            entries = self.dirs.get(dirname)
+        if entries == None:
+            entries = self._load(dirname)
+            with self.lock:
+                entries = self.dirs.setdefault(dirname, entries)
+        return entries
+
+    def stat(self, filename):
+        ''' the (cached) stat result of the file - or None if the file does not exist '''
+        dirname, name = self._split(filename)
+        entry = self._entries(dirname).get(name)
+        if entry == None or isinstance(entry, os.stat_result):
+            return entry
+        try:
+            return entry.stat()
+        except OSError:
+            return None
+
+    def exists(self, filename):
+        return self.stat(filename) != None
+
+    def refresh(self, filename):
+        ''' re-reads the stat result of a single file after it was changed '''
+        dirname, name = self._split(filename)
+        entries = self._entries(dirname)
+        try:
+            entries[name] = os.stat(filename)
+        except OSError:
+            entries.pop(name, None)
+
+    def invalidate(self, filename=None):
+        ''' Removes the file's directory from the cache - or the complete cache if no file name is given '''
+        with self.lock:
+            if filename == None:
+                self.dirs.clear()
+            else:
+                self.dirs.pop(self._split(filename)[0], None)
+
 
+def _isWritableMode(st) -> bool:
+    return (st.st_mode & stat.S_IWRITE) == stat.S_IWRITE
 
-def makeWritable(filename: str) -> None:
-    if os.path.exists(filename) and not isWritable(filename):
-        os.chmod(filename, stat.S_IWRITE)    
 
+def _stat(filename: str, statCache: StatCache=None):
+    if statCache != None:
+        return statCache.stat(filename)
+    try:
+        return os.stat(filename)
+    except OSError:
+        return None
 
-def forceRemove(filename: str) -> None:
-    if os.path.exists(filename):
+
+def isWritable(filename: str, statCache: StatCache=None) -> bool:
+    st = _stat(filename, statCache)
+    return st != None and _isWritableMode(st)
+
+
+def makeWritable(filename: str, statCache: StatCache=None) -> None:
+    st = _stat(filename, statCache)
+    if st != None and not _isWritableMode(st):
+        os.chmod(filename, stat.S_IMODE(st.st_mode) | stat.S_IWRITE)
+        if statCache != None:
+            statCache.refresh(filename)
+
+
+def forceRemove(filename: str, statCache: StatCache=None) -> None:
+    if statCache != None:
+        # the cache only saves the chmod - the file may have been created after the directory was read
+        makeWritable(filename, statCache)
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        # read-only file on Windows
         makeWritable(filename)
         os.remove(filename)
+    if statCache != None:
+        statCache.refresh(filename)
+
+
+def makeWritableAll(fileNames: List[str], statCache: StatCache=None) -> StatCache:
+    ''' makeWritable for many files - the directories are only read once
+    :return: the used stat cache
+    '''
+    if statCache == None:
+        statCache = StatCache()
+    for f in fileNames:
+        makeWritable(f, statCache)
+    return statCache
+
+
+def forceRemoveAll(fileNames: List[str], statCache: StatCache=None) -> StatCache:
+    ''' forceRemove for many files - the directories are only read once
+    :return: the used stat cache
+    '''
+    if statCache == None:
+        statCache = StatCache()
+    for f in fileNames:
+        forceRemove(f, statCache)
+    return statCache
 
             
 def getCommonDir(fileNames: List[str]) -> str:
     ''' Gets the common parent directory of given file paths '''
-    commonDir = None 
-    for f in fileNames:
-        curDir = os.path.dirname(f)
-        if commonDir == None:
-            commonDir = curDir
-        else:
-            commonDirParts = commonDir.split(os.path.sep)
-            # compare all directory elements (between seperators)
-            for idx, (commonDirPart, currentDirPart) in enumerate(zip(commonDirParts, curDir.split(os.path.sep))):
-                if commonDirPart != currentDirPart:
-                    commonDir = os.path.sep.join(commonDirParts[:idx])
+    return PathIndex(fileNames).commonDir()
+
+
+class _PathNode(object):
+    ''' Single directory within the PathIndex '''
+    __slots__ = ('children', 'files', 'count')
+
+    def __init__(self):
+        self.children = {}  # directory name -> _PathNode
+        self.files = {}  # file name -> None (ordered set)
+        self.count = 0  # number of files in the complete subtree
+
+
+class PathIndex(object):
+    ''' Trie of path components for (very) large sets of file paths.
+    
+    The path segments are interned, so equal directory names share their memory.
+    The index is built in one pass and all queries only depend on the depth of the path.
+    
+    Example:
+    index = PathIndex(Git.changedFiles(sandbox))
+    print(index.commonDir())
+    for directory, files in index.groupByDir():
+        # work on the files of one directory
+    print(index.count(os.path.join(sandbox, 'src')))
+    '''
+
+    def __init__(self, fileNames=None, sep=os.path.sep):
+        self.sep = sep
+        self.root = _PathNode()
+        if fileNames != None:
+            self.addAll(fileNames)
+
+    def _split(self, path):
+        return [sys.intern(part) for part in path.split(self.sep)]
+
+    def _dirParts(self, dirname):
+        if not dirname:
+            return []
+        if dirname == self.sep:
+            return ['']  # the root directory
+        return dirname.rstrip(self.sep).split(self.sep)
+
+    def _node(self, parts):
+        ''' the node of the given directory parts - or None if it is not in the index '''
+        node = self.root
+        for part in parts:
+            node = node.children.get(part)
+            if node == None:
+                return None
+        return node
+
+    def _join(self, parts):
+        if parts == ['']:
+            return self.sep  # the root directory
+        return self.sep.join(parts)
+
+    def add(self, filename):
+        ''' adds a single file path - returns False if the file was already in the index '''
+        parts = self._split(filename)
+        nodes = [self.root]
+        node = self.root
+        for part in parts[:-1]:
+            child = node.children.get(part)
+            if child == None:
+                child = node.children[part] = _PathNode()
+            node = child
+            nodes.append(node)
+        if parts[-1] in node.files:
+            return False
+        node.files[parts[-1]] = None
+        for node in nodes:
+            node.count += 1
+        return True
+
+    def addAll(self, fileNames):
+        for f in fileNames:
+            self.add(f)
+        return self
+
+    def __len__(self):
+        return self.root.count
+
+    def __contains__(self, filename):
+        dirname, _, name = filename.rpartition(self.sep)
+        node = self._node(dirname.split(self.sep) if dirname or filename.startswith(self.sep) else [])
+        return node != None and name in node.files
+
+    def commonDir(self):
+        ''' Gets the longest common directory of all files - None if the index is empty '''
+        if self.root.count == 0:
+            return None
+        parts = []
+        node = self.root
+        while len(node.files) == 0 and len(node.children) == 1:
+            part, node = next(iter(node.children.items()))
+            parts.append(part)
+        return self._join(parts)
+
+    def count(self, dirname=''):
+        ''' number of files in the given directory including all sub directories '''
+        node = self._node(self._dirParts(dirname))
+        return node.count if node != None else 0
+
+    def _walk(self, node, parts):
+        stack = [(node, parts)]
+        while stack:
+            node, parts = stack.pop()
+            yield node, parts
+            for part, child in reversed(list(node.children.items())):
+                stack.append((child, parts + [part]))
+
+    def groupByDir(self, dirname=''):
+        ''' yields tuples of (directory, [file paths]) for each directory containing files
+        :param dirname: restrict the result to the subtree of this directory
+        '''
+        parts = self._dirParts(dirname)
+        node = self._node(parts)
+        if node != None:
+            for node, parts in self._walk(node, parts):
+                if node.files:
+                    directory = self._join(parts)
+                    yield directory, [self.sep.join(parts + [f]) for f in node.files]
+
+    def files(self, dirname=''):
+        ''' yields all file paths below the given directory (subtree query) '''
+        for _, fileNames in self.groupByDir(dirname):
+            for f in fileNames:
+                yield f
+
+    def dirCounts(self, dirname=''):
+        ''' yields tuples of (directory, number of files in subtree) for all directories below the given directory '''
+        parts = self._dirParts(dirname)
+        node = self._node(parts)
+        if node != None:
+            for node, parts in self._walk(node, parts):
+                yield self._join(parts), node.count
+
+
+def _matchesAny(name, patterns):
+    for pattern in patterns:
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+
+def walk(top: str, numThreads: int=8, include: List[str]=None, exclude: List[str]=None, prune=None,
+         dirs: bool=False, followLinks: bool=False, statCache: StatCache=None, onError=None):
+    ''' Walks the directory tree with several threads calling os.scandir in parallel.
+    The os.DirEntry objects are yielded as soon as they are found - the order is not defined.
+    
+    Example:
+    for entry in walk(sandbox, include=['*.py'], exclude=['.git', '__pycache__']):
+        print(entry.path)
+    
+    :param top: the root directory
+    :param numThreads: maximum number of directories that are read in parallel
+    :param include: glob patterns for file names to be returned. Default: all files
+    :param exclude: glob patterns for file and directory names to be ignored - excluded directories are not entered
+    :param prune: function receiving the DirEntry of a directory - returns True if the directory should not be entered
+    :param dirs: if True also the (not excluded) directories are returned
+    :param followLinks: enter symbolic links to directories
+    :param statCache: the scanned entries are added to the cache - so following calls of e.g. isWritable do not stat again
+    :param onError: function receiving the OSError when a directory cannot be read. Default: errors are ignored
+    Exceptions raised by prune or onError stop the walk and are re-raised by the generator.
+    '''
+    lock = Condition()
+    pending = deque([top])
+    found = deque()
+    state = {'working': 0, 'stopped': False, 'error': None}
+
+    def scan(dirname):
+        try:
+            with os.scandir(dirname) as it:
+                entries = list(it)
+        except OSError as ex:
+            if onError:
+                onError(ex)
+            return [], []
+        if statCache != None:
+            statCache.fill(dirname, entries)
+        subDirs = []
+        results = []
+        for entry in entries:
+            if exclude and _matchesAny(entry.name, exclude):
+                continue
+            try:
+                isDir = entry.is_dir(follow_symlinks=followLinks)
+            except OSError:
+                isDir = False
+            if isDir:
+                if dirs:
+                    results.append(entry)
+                if not (prune and prune(entry)):
+                    subDirs.append(entry.path)
+            elif not include or _matchesAny(entry.name, include):
+                results.append(entry)
+        return subDirs, results
+
+    def run():
+        while True:
+            with lock:
+                while not pending and state['working'] > 0 and not state['stopped']:
+                    lock.wait()
+                if state['stopped'] or not pending:
+                    lock.notify_all()  # everything is done
+                    return
+                dirname = pending.popleft()
+                state['working'] += 1
+            subDirs, results = [], []
+            try:
+                subDirs, results = scan(dirname)
+            except BaseException as ex:
+                # e.g. raised by prune or onError - stop the walk and re-raise it in the generator
+                with lock:
+                    state['error'] = ex
+                    state['stopped'] = True
+            finally:
+                with lock:
+                    pending.extend(subDirs)
+                    found.extend(results)
+                    state['working'] -= 1
+                    lock.notify_all()
+
+    threads = [Thread(target=run) for _ in range(max(1, numThreads))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while True:
+            with lock:
+                while not found and (pending or state['working'] > 0) and not state['stopped']:
+                    lock.wait()
+                if state['error'] != None:
+                    raise state['error']
+                if not found:
                     break
-    return commonDir
+                results = list(found)
+                found.clear()
+            for entry in results:
+                yield entry
+    finally:
+        # also reached on GeneratorExit - stop the remaining threads
+        with lock:
+            state['stopped'] = True
+            lock.notify_all()
+        for t in threads:
+            t.join()
 
 
 class BackupFile:
@@ -141,6 +508,7 @@ class BackupFile:
                 
     @staticmethod
     def workOnContentLines(filename, fun):
+        import ExecHelper  # imported here - ExecHelper imports FileHelper
         with BackupFile(filename) as bk:
             linesIn = list(ExecHelper.readLines(filename))
             changed, linesOut = fun(linesIn)
@@ -3,23 +3,256 @@ Created on 16.02.2020
 
 @author: Michael Schulte
 '''
+from functools import lru_cache
+from itertools import zip_longest
 from operator import getitem
 import os
 import sys
-from time import sleep
+from time import monotonic, sleep
 import traceback
-import zipfile
 
-from FileHelper import makeWritable
+from FileHelper import forceRemove, makeWritable
+
+# openpyxl is imported with the first workbook (see _importPyxl) - scripts that never touch a workbook don't pay for it
+_pyxl = {} # name -> imported openpyxl class / function
+_pyxlEnabled = None
+
+
+def _importPyxl():
+    ''' imports openpyxl on first use - returns False if it is not installed '''
+    global _pyxlEnabled
+    if _pyxlEnabled == None:
+        try:
+            from openpyxl import Workbook
+            from openpyxl.styles import Font
+            from openpyxl import load_workbook
+            from openpyxl.cell import WriteOnlyCell
+            from openpyxl.utils import column_index_from_string, get_column_letter
+            _pyxl.update(Workbook=Workbook, Font=Font, load_workbook=load_workbook, WriteOnlyCell=WriteOnlyCell,
+                         column_index_from_string=column_index_from_string, get_column_letter=get_column_letter)
+            _pyxlEnabled = True
+        except ImportError:
+            _pyxlEnabled = False
+            sys.stderr.write("Failed to import openpyxl library - install it via : pip install openpyxl\npip is located in subfolder Scripts of Python-Installation")
+    return _pyxlEnabled
+
+
+def __getattr__(name):
+    # pyxl_enabled and the openpyxl names (e.g. from PyxlHelper import Font) trigger the import of openpyxl
+    if name == 'pyxl_enabled':
+        return _importPyxl()
+    if name in ('Workbook', 'Font', 'load_workbook', 'WriteOnlyCell', 'column_index_from_string', 'get_column_letter') \
+            and _importPyxl():
+        return _pyxl[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+_fonts = {}
+
+
+def getFont(bold=False, sz=None):
+    ''' shared (cached) font object - creating a new Font for each cell is expensive '''
+    key = (bold, sz)
+    font = _fonts.get(key)
+    if font == None:
+        _importPyxl()
+        font = _fonts[key] = _pyxl['Font'](bold=bold, sz=sz) if sz else _pyxl['Font'](bold=bold)
+    return font
+
+
+def columnWidth(maxLength):
+    ''' the column width needed for the given maximum content length '''
+    return (maxLength + 1) * 1.4 # this is PI * thumb
+
+
+@lru_cache(maxsize=65536)
+def _displayText(s):
+    ''' the displayed part of the (string) value - cached, as reports repeat the same values '''
+    if s.startswith('=') and '"' in s: # remove Hyperlink and other formula stuff
+        idx = s.rfind('"')
+        s = s[s.rfind('"', 0, idx-1)+1:idx]
+    return s
+
+
+@lru_cache(maxsize=65536, typed=True) # True, 1 and 1.0 are equal but displayed differently
+def _displayLen(value):
+    try:
+        return len(_displayText(str(value)))
+    except UnicodeEncodeError:
+        return 0
+
+
+def _isSmall(font):
+    return font != None and font.sz and font.sz < 8
+
+
+def valueLen(value, font=None):
+    ''' length of the displayed value - analog to PyxlWorkbook.cellLen but without a cell '''
+    if value == None or _isSmall(font):
+        return 0
+    try:
+        return _displayLen(value)
+    except TypeError: # not hashable
+        return len(_displayText(str(value)))
+
+
+def columnLen(values, font=None):
+    ''' maximum valueLen of all values of a column - without the per value cache lookups '''
+    if _isSmall(font):
+        return 0
+    texts = [str(value) for value in values if value != None]
+    formulas = [s for s in texts if s.startswith('=')]
+    if formulas:
+        return max(max((len(s) for s in texts if not s.startswith('=')), default=0),
+                   max(len(_displayText(s)) for s in formulas))
+    return max(map(len, texts), default=0)
+
+
+class _ColumnWidths(object):
+    ''' Keeps track of the maximum content length of each column of a worksheet '''
+    def __init__(self):
+        self.maxLen = {} # column index (starting with 1) -> length
+        self.maxRow = 0 # last row written with the tracking methods
+
+    def update(self, column, length):
+        if length > self.maxLen.get(column, 0):
+            self.maxLen[column] = length
+
+    def updateCell(self, cell):
+        self.update(cell.column, PyxlWorkbook.cellLen(cell))
+
+    def updateRow(self, values, font=None):
+        for column, value in enumerate(values, 1):
+            self.update(column, valueLen(value, font))
+
+    def trackRow(self, row):
+        if row > self.maxRow:
+            self.maxRow = row
+
+    def scanUntracked(self, ws):
+        ''' Cells written directly to the worksheet (ws.cell / ws.append) are not tracked:
+        scans the rows below the last tracked row and the columns without any tracked value.
+        '''
+        if ws.max_row > self.maxRow:
+            for row in ws.iter_rows(min_row=self.maxRow + 1):
+                for cell in row:
+                    self.updateCell(cell)
+        if self.maxRow > 0:
+            for column in range(1, ws.max_column + 1):
+                if column not in self.maxLen:
+                    for cells in ws.iter_cols(min_col=column, max_col=column, max_row=self.maxRow):
+                        for cell in cells:
+                            self.updateCell(cell)
+
+    def apply(self, ws):
+        for column, length in self.maxLen.items():
+            ws.column_dimensions[_pyxl['get_column_letter'](column)].width = columnWidth(length)
+
+
+def _toList(values):
+    ''' numpy arrays are converted to lists of python values '''
+    return values.tolist() if hasattr(values, 'tolist') else values
+
+
+def _tableRows(data, header):
+    ''' the rows and header of a list of rows, a dict of columns or a 2-D numpy array '''
+    if isinstance(data, dict):
+        if header == None:
+            header = list(data.keys())
+        columns = [list(_toList(col)) for col in data.values()]
+        lengths = set(len(col) for col in columns)
+        if len(lengths) > 1:
+            raise ValueError("the columns have different lengths: %s" % dict((name, len(col)) for name, col in zip(data, columns)))
+        return zip(*columns), header
+    return _toList(data), header
+
+
+class SheetRecorder(object):
+    ''' Records the rows of one worksheet in a worker process (see PyxlWorkbook.buildSheets).
+    The rows are stored as pickled batches in a temporary file - so the memory stays bounded.
+    '''
+    def __init__(self, title, batch_size=1000):
+        self.title = title
+        self.batchSize = batch_size
+        self.batch = []
+        from tempfile import mkstemp
+        fh, self.filename = mkstemp(suffix=".rows")
+        self.fh = os.fdopen(fh, 'wb')
+
+    def appendRow(self, values, bold=False, sz=None):
+        ''' same as PyxlWorkbook.appendRow '''
+        self.batch.append((list(values), bold, sz))
+        if len(self.batch) >= self.batchSize:
+            self._flush()
+
+    def writeTable(self, data, header=None):
+        ''' appends a list of rows, dict of columns or 2-D numpy array (see PyxlWorkbook.writeTable) '''
+        rows, header = _tableRows(data, header)
+        if header:
+            self.appendRow(header, bold=True)
+        for values in rows:
+            self.appendRow(values)
+
+    def _flush(self):
+        if self.batch:
+            import pickle
+            pickle.dump(self.batch, self.fh, pickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def close(self):
+        self._flush()
+        self.fh.close()
+        return self.filename
+
+    @staticmethod
+    def replay(filename):
+        ''' yields the recorded (values, bold, sz) and removes the file afterwards '''
+        import pickle
+        try:
+            with open(filename, 'rb') as f:
+                while True:
+                    try:
+                        batch = pickle.load(f)
+                    except EOFError:
+                        break
+                    for row in batch:
+                        yield row
+        finally:
+            os.remove(filename)
+
+
+def _buildSheet(builder, title, args):
+    ''' executed in the worker process '''
+    sheet = SheetRecorder(title)
+    try:
+        builder(sheet, *args)
+    except:
+        sheet.close()
+        os.remove(sheet.filename)
+        raise
+    return sheet.close()
+
+
+_pendingSaves = set() # workbooks with a running background save
+
+
+def _waitForSaves():
+    ''' at exit: the background saves run in daemon threads - without waiting the files would not be written '''
+    for wb in list(_pendingSaves):
+        try:
+            wb.wait()
+        except:
+            sys.stderr.write("Background save of %s failed:\n" % wb.filename)
+            traceback.print_exc()
+
+
+def _registerSave(wb):
+    if not _pendingSaves:
+        import atexit
+        atexit.unregister(_waitForSaves)
+        atexit.register(_waitForSaves)
+    _pendingSaves.add(wb)
 
-try:
-    from openpyxl import Workbook
-    from openpyxl.styles import Font
-    from openpyxl import load_workbook
-    pyxl_enabled = True
-except ImportError:
-    pyxl_enabled = False
-    sys.stderr.write("Failed to import openpyxl library - install it via : pip install openpyxl\npip is located in subfolder Scripts of Python-Installation")
 
 class PyxlWorkbook(object):
     '''
@@ -40,19 +273,50 @@ class PyxlWorkbook(object):
         
     Also some helper functions are provided.
     
+    For large reports use the write-only mode - the rows are streamed to the file with constant memory:
+    with PyxlWorkbook(filename, write_only=True) as wb:
+        ws = wb.createSheet('Report')
+        wb.appendRow(ws, header, bold=True)
+        for row in rows:
+            wb.appendRow(ws, row)
+    
+    Saving in the background - the next workbook can be computed while the file is written:
+    saving = wb.close(background=True)
+    # ... 
+    saving.join()
+    
     '''
-    def __init__(self, filename, read_only=False, update=False):
+    def __init__(self, filename, read_only=False, update=False, write_only=False, width_sample_rows=1000, track_widths=False,
+                 background_save=False):
         ''' Creates the helper which can be used as workbook.
         :filename: full path to excel file
         :read_only: open the existing file in read-only mode. http: files are automatically downloaded and saved as temporary file.
         :update: create or update the file - if it exists. Default = False: overwrite the entire file (e.g. when generating a report).
+        :write_only: stream the rows appended with appendRow directly to the file (openpyxl write-only workbook). 
+            Cells cannot be read or changed afterwards.
+        :width_sample_rows: in write-only mode the column widths have to be written before the rows - 
+            so they are calculated from this number of first rows of each sheet which are kept in memory.
+        :track_widths: the cells are written with setCell / appendRow / writeTable - the column widths are collected 
+            while writing and only cells written directly to the worksheet are scanned when saving.
+        :background_save: close() (also at the end of the with-statement) saves the file in a background thread. 
+            Call wait() before using the file.
         '''
         self.filename = filename
         self.fh = None
-        self.wb = Workbook()
         self.readOnly = read_only
+        self.writeOnly = write_only
+        self.widthSampleRows = width_sample_rows
+        self.trackWidths = track_widths
+        self.backgroundSave = background_save
+        self.saving = None # handle of the background save
+        self.widths = {} # worksheet title -> _ColumnWidths
+        self.pendingRows = {} # worksheet title -> rows not yet written in write-only mode
+        if not _importPyxl():
+            raise ImportError("openpyxl is not installed")
+        self.wb = _pyxl['Workbook'](write_only=write_only)
         self.url = ''
         assert not (read_only and update), "can only set read_only or update - not both of them!"
+        assert not (write_only and (read_only or update)), "write_only cannot be combined with read_only or update!"
         self.update = update and os.path.exists(filename)
 
     def __getattr__(self, attr):
@@ -79,97 +343,379 @@ class PyxlWorkbook(object):
         traceback.print_exception(exc_type, value, tb)                
                     
     def _trySave(self):
+        ''' Saves to a temporary file next to the target and replaces the target in one step.
+        So the target is either the old or the new complete file - never a partially written one.
+        '''
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            sys.stderr.write("Invalid path %s\n" % (self.filename))
+            raise IOError("Invalid path " + self.filename)
+        tmpfile = self.filename + '~'
+        forceRemove(tmpfile)
+        try:
+            self.wb.save(tmpfile)
+            self._tryReplace(tmpfile)
+        except:
+            forceRemove(tmpfile)
+            raise
+
+    def _tryReplace(self, tmpfile, maxDelay=2.0, timeout=120.0):
+        ''' renames the temporary file to the target - waits with increasing delays while the target is locked.
+        Other errors (e.g. the target is a directory) and a target that is still locked after timeout seconds are raised.
+        '''
         printError = True
+        delay = 0.05
+        end = monotonic() + timeout
         while True:
             try:
-                self.wb.save(self.filename)
+                os.replace(tmpfile, self.filename)
                 break
-            except IOError as ex:
+            except PermissionError:
+                if monotonic() + delay > end:
+                    raise
                 if printError:
-                    if not os.path.exists(os.path.dirname(self.filename)):
-                        sys.stderr.write("Invalid path %s\n" % (self.filename))
-                        raise(ex)
                     sys.stderr.write("File access error: Please close the excel document first!!\n")
                     printError = False
-                sleep(0.1)
+                sleep(delay)
+                delay = min(delay * 2, maxDelay)
+        if not printError:
+            sys.stderr.write("... closed\n")
     
-    def _tryOpen(self):
+    def _tryOpen(self, timeout=120.0):
         printError = True
         assert(not self.readOnly)
         makeWritable(self.filename)
 
+        end = monotonic() + timeout
         while True:
             try:
-                self.fh = open(self.filename, 'a' if self.update else 'w') # ensure write access during processing
+                self.fh = open(self.filename, 'a') # ensure write access during processing - the file is replaced when saving
                 if not printError:
                     sys.stderr.write("... closed\n")
                 break
-            except IOError as ex:
-                if os.path.exists(os.path.dirname(self.filename)):
-                    if printError:
-                        sys.stderr.write("File access error: Please close the excel document first!!\n")
-                        printError = False
-                    sleep(0.1)
-                else:
-                    raise ex
+            except PermissionError:
+                # only a locked file is waited for - e.g. a directory or an invalid path is raised
+                if monotonic() > end:
+                    raise
+                if printError:
+                    sys.stderr.write("File access error: Please close the excel document first!!\n")
+                    printError = False
+                sleep(0.1)
         if self.update:
+            import zipfile # openpyxl imports it anyway
             try:
-                self.wb = load_workbook(self.filename, keep_vba=self.filename.endswith('.xlsm'))
+                self.wb = _pyxl['load_workbook'](self.filename, keep_vba=self.filename.endswith('.xlsm'))
             except zipfile.BadZipfile:
                 sys.stderr.write("Could not open Excel-file - recreating it!\n")
                 self.update = False  
     
-    def close(self):
+    def close(self, background=None):
+        ''' Adjusts the columns and saves the workbook.
+        :background: save in a background thread. Default: background_save given in the constructor.
+            Returns a handle - its join() waits until the file is written and re-raises a save error.
+            The workbook must not be changed anymore after calling close.
+        '''
         if self.readOnly:
-            # hack for bug in openpyxl
             try:
-                self.wb._archive.close()
+                self.wb.close()
             except:
-                pass
-
-        else:
-            for ws in self.worksheets:
-                self.adjustColumns(ws)
-            if self.fh != None:
+                # hack for bug in older openpyxl versions
                 try:
-                    os.close(self.fh)
-                    self.fh = None
+                    self.wb._archive.close()
                 except:
                     pass
-            self._trySave()
+            return None
+
+        if self.fh != None:
+            try:
+                self.fh.close()
+                self.fh = None
+            except:
+                pass
+        if background == None:
+            background = self.backgroundSave
+        if background:
+            from AsyncExec import AsyncExec
+            self.saving = AsyncExec(1).add(self._save)
+            _registerSave(self)
+            return self.saving
+        self._save()
+        return None
+
+    def _save(self):
+        for ws in self.worksheets:
+            if self.writeOnly:
+                self._flushRows(ws)
+            else:
+                self.adjustColumns(ws)
+        self._trySave()
+
+    def wait(self):
+        ''' waits for a background save to finish '''
+        if self.saving != None:
+            saving = self.saving
+            self.saving = None
+            _pendingSaves.discard(self)
+            saving.join()
         
     def prepare(self):
-        self.wb = Workbook()
+        self.widths = {}
+        self.pendingRows = {}
+        if self.readOnly:
+            # the sheets are only parsed when their rows are iterated
+            self.wb = _pyxl['load_workbook'](self.filename, read_only=True, data_only=True, keep_links=False)
+            return self
+        self.wb = _pyxl['Workbook'](write_only=self.writeOnly)
         exists = os.path.exists(self.filename)
         if exists:
             self._tryOpen()
 
         return self # for chained calls  
     
+    def _sheet(self, ws):
+        if ws == None:
+            return self.active
+        if isinstance(ws, str):
+            return self.wb[ws]
+        return ws
+
+    def iterRows(self, ws=None, columns=None, values_only=True, min_row=1, max_row=None):
+        ''' Yields the rows of the worksheet as tuples. 
+        In read-only mode the rows are streamed from the file with bounded memory.
+        :ws: worksheet or its name. Default: the active worksheet
+        :columns: only return these columns - list of column indices (starting with 1) or letters like 'C'
+        :values_only: return the cell values instead of the cells
+        :min_row: first row to return (starting with 1)
+        :max_row: last row to return. Default: all rows
+        '''
+        ws = self._sheet(ws)
+        if not columns:
+            for row in ws.iter_rows(min_row=min_row, max_row=max_row, values_only=values_only):
+                yield row
+            return
+        columns = [_pyxl['column_index_from_string'](c) if isinstance(c, str) else c for c in columns]
+        minCol = min(columns)
+        indices = [c - minCol for c in columns]
+        for row in ws.iter_rows(min_row=min_row, max_row=max_row, min_col=minCol, max_col=max(columns), values_only=values_only):
+            yield tuple(row[idx] if idx < len(row) else None for idx in indices)
+
+    def iterColumns(self, ws=None, columns=None, batch_size=10000, min_row=1, max_row=None, arrays=False):
+        ''' Yields the rows of the worksheet in batches - as a list of value lists per column.
+        Use this to ingest large sheets in chunks of bounded size.
+        
+        for names, values in wb.iterColumns('Data', columns=['A', 'D'], min_row=2, arrays=True):
+            total += values.sum()
+        
+        :batch_size: maximum number of rows in each batch
+        :arrays: numeric columns are returned as numpy arrays (requires numpy)
+        See iterRows for the other parameters.
+        '''
+        batch = []
+        for row in self.iterRows(ws, columns, True, min_row, max_row):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield self._toColumns(batch, arrays)
+                batch = []
+        if batch:
+            yield self._toColumns(batch, arrays)
+
+    @staticmethod
+    def _toColumns(rows, arrays):
+        width = max(len(row) for row in rows)
+        cols = [[row[idx] if idx < len(row) else None for row in rows] for idx in range(width)]
+        if arrays:
+            import numpy
+            for idx, col in enumerate(cols):
+                if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in col):
+                    cols[idx] = numpy.array(col)
+        return cols
+
     def createUrl(self, url, label):                        
         return '=HYPERLINK("{}", "{}")'.format(url, label)
 
-    def mkBold(self, ws, row):
+    def createSheet(self, title=None):
+        ''' creates a new worksheet - in write-only mode this is the only way to get a worksheet '''
+        return self.wb.create_sheet(title)
+
+    def appendRow(self, ws, values, bold=False, sz=None):
+        ''' Appends a row of values to the worksheet and keeps track of the column widths.
+        :bold: make the complete row bold (e.g. header)
+        :sz: font size of the complete row
+        '''
         assert(not self.readOnly)
-        rows = list(ws.rows)
-        if row <= len(rows):
-            for cell in rows[row-1]:
-                cell.font = Font(bold=True)
+        font = getFont(bold, sz) if (bold or sz) else None
+        self.widths.setdefault(ws.title, _ColumnWidths()).updateRow(values, font)
+        if not self.writeOnly:
+            ws.append(values)
+            self.widths[ws.title].trackRow(ws.max_row)
+            if font != None:
+                for cell in ws[ws.max_row]:
+                    cell.font = font
+            return
+        if font != None:
+            values = [self._writeOnlyCell(ws, value, font) for value in values]
+        self._appendWriteOnly(ws, values)
+
+    def _appendWriteOnly(self, ws, values):
+        pending = self.pendingRows.setdefault(ws.title, [])
+        if pending == None: # column widths are already written
+            ws.append(values)
+        else:
+            pending.append(values)
+            if len(pending) >= self.widthSampleRows:
+                self._flushRows(ws)
+
+    @staticmethod
+    def _writeOnlyCell(ws, value, font):
+        cell = _pyxl['WriteOnlyCell'](ws, value=value)
+        cell.font = font
+        return cell
+
+    def _flushRows(self, ws):
+        ''' write-only mode: set the column widths from the sampled rows and write them '''
+        pending = self.pendingRows.get(ws.title)
+        if pending != None:
+            self.widths[ws.title].apply(ws)
+            self.pendingRows[ws.title] = None
+            for values in pending:
+                ws.append(values)
+
+    def writeTable(self, ws, data, row=None, column=1, header=None, column_fonts=None):
+        ''' Writes tabular data in one go - much faster than writing cell by cell.
+        Rows appended at the first column are written with ws.append - only the cells of the header and
+        the columns with fonts are touched individually. The column widths are computed once per column.
+        
+        wb.writeTable(ws, {'Name': names, 'Size': numpyArray}, column_fonts={1: getFont(sz=4)})
+        
+        :data: list of rows, dict of column name -> column values (the names are used as header) or 2-D numpy array
+        :row: first row to write. Default: append below the last row (the only possibility in write-only mode)
+        :column: first column (starting with 1)
+        :header: list of column names written in bold above the data
+        :column_fonts: dict of column offset within the data (starting with 0) -> font for all cells of the column
+        :return: the last written row - None in write-only mode (the rows may still be buffered for the column widths)
+        '''
+        assert(not self.readOnly)
+        rows, header = _tableRows(data, header)
+        fonts = column_fonts or {}
+        if self.writeOnly:
+            assert row == None and column == 1, "write-only mode can only append rows"
+            if header:
+                self.appendRow(ws, header, bold=True)
+            if not fonts:
+                for values in rows:
+                    self.appendRow(ws, values)
+                return None
+            widths = self.widths.setdefault(ws.title, _ColumnWidths())
+            for values in rows:
+                for idx, value in enumerate(values):
+                    widths.update(idx + 1, valueLen(value, fonts.get(idx)))
+                self._appendWriteOnly(ws, [self._writeOnlyCell(ws, v, fonts[idx]) if idx in fonts else v for idx, v in enumerate(values)])
+            return None
+
+        rows = list(rows)
+        if row == None and column == 1:
+            # plain appends - the cells are created by openpyxl without one ws.cell call per value
+            if header:
+                ws.append(header)
+            for values in rows:
+                ws.append(values)
+            r = ws.max_row
+            first = r - len(rows) - (1 if header else 0) + 1
+        else:
+            r = ws.max_row + 1 if row == None else row
+            if row == None and ws.max_row == 1 and ws.max_column == 1 and ws.cell(row=1, column=1).value == None:
+                r = 1 # empty worksheet
+            first = r
+            for values in ([header] if header else []) + rows:
+                for idx, value in enumerate(values):
+                    ws.cell(row=r, column=column + idx, value=value)
+                r += 1
+            r -= 1
+        if header:
+            font = getFont(bold=True)
+            for idx in range(len(header)):
+                ws.cell(row=first, column=column + idx).font = font
+            first += 1
+        for idx, font in fonts.items():
+            for cellRow in range(first, r + 1):
+                ws.cell(row=cellRow, column=column + idx).font = font
+
+        # the column widths in one pass per column
+        widths = self.widths.setdefault(ws.title, _ColumnWidths())
+        for idx, col in enumerate(zip_longest(*rows)):
+            widths.update(column + idx, columnLen(col, fonts.get(idx)))
+        if header:
+            for idx, value in enumerate(header):
+                widths.update(column + idx, valueLen(value))
+        widths.trackRow(r)
+        return r
+
+    def buildSheets(self, builder, sheets, processes=None):
+        ''' Builds the worksheets in parallel worker processes and adds them in the given order.
+        
+        def buildReport(sheet, component):
+            # executed in a separate process
+            sheet.appendRow(['File', 'Lines'], bold=True)
+            for f in files(component):
+                sheet.appendRow([f, countLines(f)])
+        
+        with PyxlWorkbook(filename, write_only=True) as wb:
+            wb.buildSheets(buildReport, [(c, (c,)) for c in components])
+            
+        The workers only compute the rows - the sheets are written by the calling process as soon as
+        the worker is finished, so the strings and styles are shared like in a serially built workbook.
+        This only pays off when the computation in the builder dominates: each row is still pickled, replayed
+        with appendRow and written serially - for cheap rows building the sheets directly is faster.
+        :builder: module level function (it has to be pickled) receiving a SheetRecorder and the arguments
+        :sheets: list of (title, arguments tuple) - one worker call per sheet
+        :processes: number of worker processes. Default: number of CPUs
+        :return: the created worksheets
+        '''
+        assert(not self.readOnly)
+        result = []
+        futures = []
+        from concurrent.futures import ProcessPoolExecutor
+        try:
+            with ProcessPoolExecutor(processes) as pool:
+                futures = [pool.submit(_buildSheet, builder, title, args) for title, args in sheets]
+                for (title, _), future in zip(sheets, futures):
+                    ws = self.createSheet(title)
+                    try:
+                        rows = SheetRecorder.replay(future.result())
+                    except:
+                        for f in futures:
+                            f.cancel()
+                        raise
+                    for values, bold, sz in rows:
+                        self.appendRow(ws, values, bold, sz)
+                    result.append(ws)
+        finally:
+            # after an error the recordings of the other finished sheets are not replayed
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() == None:
+                    forceRemove(future.result())
+        return result
+
+    def mkBold(self, ws, row):
+        assert(not self.readOnly and not self.writeOnly)
+        if row <= ws.max_row:
+            font = getFont(bold=True)
+            for cell in ws[row]:
+                cell.font = font
                 
     def mkSmall(self, cell, sz=4):
-        assert(not self.readOnly)
-        cell.font = Font(sz=sz)
+        assert(not self.readOnly and not self.writeOnly)
+        cell.font = getFont(sz=sz)
 
     @staticmethod
     def content(cell):
         ''' get the content of the cell without formatting / URL '''
         try:
             s = str(cell.value)
-            if cell.style == 'Output' or (cell.font and ((not cell.font.sz) or (cell.font.sz < 8))):
-                return 0 
+            if cell.style == 'Output' or _isSmall(cell.font):
+                return "" 
             if s.startswith('=') and '"' in s: # remove Hyperlink and other formula stuff
-                idx = s.rfind('"')
-                s = s[s.rfind('"', 0, idx-1)+1:idx]
+                return _displayText(s)
             elif cell.style == 'Hyperlink':
                 return ""
         except UnicodeEncodeError:
@@ -179,19 +725,45 @@ class PyxlWorkbook(object):
     @classmethod
     def cellLen(cls, cell):
         ''' length of the cell content (to calculate the needed column width)'''
-        return len(cls.content(cell))
+        if cell.value == None:
+            return 0
+        if cell.has_style and (cell.style in ('Output', 'Hyperlink') or _isSmall(cell.font)):
+            return len(cls.content(cell))
+        return valueLen(cell.value)
+
+    def setCell(self, ws, row, column, value, bold=False, sz=None):
+        ''' Writes the value into the cell and keeps track of the column width.
+        The width only grows - a shorter value does not shrink the column.
+        Set the font with bold / sz here: later style changes (e.g. mkSmall) are not considered for the width.
+        '''
+        assert(not self.readOnly and not self.writeOnly)
+        cell = ws.cell(row=row, column=column, value=value)
+        if bold or sz:
+            cell.font = getFont(bold, sz)
+        widths = self.widths.setdefault(ws.title, _ColumnWidths())
+        widths.updateCell(cell)
+        widths.trackRow(row)
+        return cell
             
     def adjustColumns(self, ws=None):
-        ''' tries to adjust the cell width to fit the content '''
+        ''' tries to adjust the cell width to fit the content 
+        With track_widths the widths collected by setCell / appendRow / writeTable are used - only the rows below
+        the last tracked row and the columns without tracked values are checked (e.g. written with ws.append).
+        Otherwise all cells of the worksheet are checked.
+        '''
         assert(not self.readOnly)
         if ws == None:
             ws = self.active
-        for col in ws.columns:
-            max_length = 0
-            for cell in col:
-                if self.cellLen(cell) > max_length:
-                    max_length = self.cellLen(cell)
-            adjusted_width = (max_length + 1) * 1.4 # this is PI * thumb
-            ws.column_dimensions[col[0].column].width = adjusted_width
+        if self.trackWidths:
+            widths = self.widths.setdefault(ws.title, _ColumnWidths())
+            if not self.writeOnly:
+                widths.scanUntracked(ws)
+            widths.apply(ws)
+            return self
+        widths = _ColumnWidths()
+        for row in ws.iter_rows():
+            for cell in row:
+                widths.updateCell(cell)
+        widths.apply(ws)
         return self
 
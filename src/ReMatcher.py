@@ -1,5 +1,34 @@
 import re
 import copy
+import mmap
+from threading import Lock, local
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+
+_backRef = re.compile(r'\\[1-9]|\(\?P=')
+_globalFlags = re.compile(r'\(\?[aiLmsux]+\)')
+_namedGroup = re.compile(r'\(\?P<\w+>')
+
+_compiledLock = Lock()
+_compiledCache = {}
+
+
+def compiled(pattern, flags=0):
+    ''' Process wide cache of compiled patterns - unlike the cache of the re module it is never purged.
+    Compiled patterns can be shared by all threads.
+    '''
+    key = (type(pattern), pattern, flags)
+    regex = _compiledCache.get(key)
+    if regex == None:
+        regex = re.compile(pattern, flags)
+        with _compiledLock:
+            regex = _compiledCache.setdefault(key, regex)
+    return regex
 
 
 class ReMatcher(object):
@@ -22,13 +51,35 @@ class ReMatcher(object):
     
     for item in myPattern('bla bla'):
         print(item)
+    
+    or a lazy search over large strings, bytes, mmaps or complete files:
+    
+    for start, end, text, groups in myPattern.finditerFile('huge.log'):
+        print(start, text, groups)
+    
+    One instance can be shared by several threads (e.g. AsyncExec workers): the last match
+    is stored per thread. Alternatively matchResult returns the match object without storing it.
     '''
-    def __init__(self, matchstring):
-        self.regex = re.compile(matchstring)
+    def __init__(self, matchstring, flags=0):
+        self.regex = compiled(matchstring, flags)
+        self.local = local()
+
+    @property
+    def m(self):
+        ''' the last match of the current thread '''
+        return getattr(self.local, 'm', None)
+
+    @m.setter
+    def m(self, m):
+        self.local.m = m
 
     def match(self,chk):
-        self.m = self.regex.match(chk)
-        return bool(self.m)
+        self.local.m = self.regex.match(chk)
+        return bool(self.local.m)
+
+    def matchResult(self, chk):
+        ''' match without storing the result - returns the match object or None '''
+        return self.regex.match(chk)
     
     def findall(self, chk):
         return self.regex.findall(chk)
@@ -38,14 +89,257 @@ class ReMatcher(object):
         return self.regex.findall(chk)
 
     def group(self,i):
-        return self.m.group(i)
+        return self.local.m.group(i)
     
     def groups(self):
-        return self.m.groups()
+        return self.local.m.groups()
     
     def copy(self):
-        return copy.copy(self)
+        ''' not needed for threads anymore - the copy shares the compiled pattern but has its own match '''
+        cp = copy.copy(self)
+        cp.local = local()
+        cp.m = self.m
+        return cp
+
+    def __getstate__(self):
+        ''' the matches of the threads are not copied / pickled (e.g. when passed to worker processes) '''
+        state = dict(self.__dict__)
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = local()
     
-    def __iter__(self):
-        return self
+    def _regexFor(self, chk):
+        ''' the compiled pattern for str or bytes-like content - bytes patterns avoid decoding.
+        A str pattern is used as ASCII bytes pattern on bytes-like content: \\w, \\d, \\s and re.IGNORECASE only
+        cover ASCII and . matches a single byte. Non-ASCII str patterns raise a ValueError - use a bytes pattern instead.
+        '''
+        pattern = self.regex.pattern
+        if isinstance(chk, str) == isinstance(pattern, str):
+            return self.regex
+        if isinstance(pattern, str):
+            if not pattern.isascii():
+                raise ValueError("non-ASCII str pattern %r cannot be used on bytes - use a bytes pattern" % pattern)
+            return compiled(pattern.encode('ascii'), self.regex.flags & ~re.UNICODE)
+        return compiled(pattern.decode('utf-8'), self.regex.flags)
+
+    def finditer(self, chk):
+        ''' Yields the match objects lazily. chk can be a str or a bytes-like object (bytes, bytearray, mmap) - see _regexFor.
+        Searches span the complete input - use re.MULTILINE / re.DOTALL in the flags for multi-line patterns.
+        '''
+        return self._regexFor(chk).finditer(chk)
+
+    def finditerFile(self, filename):
+        ''' Yields (start, end, text, groups) of the matches in the file without reading it into memory and without decoding it.
+        The file is memory mapped and searched with the bytes version of the pattern - so the text and the groups are bytes.
+        No match objects are returned: they would refer to the map that is closed after the iteration.
+        '''
+        with open(filename, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return  # empty file cannot be mapped
+            try:
+                for m in self.finditer(mm):
+                    yield m.start(), m.end(), m.group(0), m.groups()
+            finally:
+                try:
+                    mm.close()
+                except BufferError:
+                    pass  # the search was stopped early and still references the map - closed when it is released
         
+
+
+def _requiredLiteral(pattern, flags=0):
+    ''' the longest literal text that has to be part of each match of the pattern - or None '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return None
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+    best = ''
+    current = []
+    for op, av in list(parsed) + [(None, None)]:
+        if op == sre_constants.LITERAL:
+            current.append(chr(av))
+        else:
+            if len(current) > len(best):
+                best = ''.join(current)
+            current = []
+            if op == sre_constants.BRANCH:
+                return None  # literals could be optional in alternatives
+    return best or None
+
+
+class MultiReMatcher(object):
+    ''' Matches many regular expressions with a single regex call.
+    The patterns are combined into one alternation - the first pattern (in the given order) that matches wins,
+    also for search: a pattern with a lower index matching further right is preferred to an earlier position.
+    Patterns that cannot be combined (back references, global inline flags) are matched separately.
+    The groups of the matching pattern are accessed by number - group names are not kept.
+
+    triage = MultiReMatcher([r'ERROR: (.*)', r'WARNING \[(\d+)\]: (.*)', r'.*Segmentation fault'])
+    for line in readLines(cmd):
+        if triage.match(line):
+            print(triage.index, triage.groups())
+
+    :param patterns: list of pattern strings
+    :param prefilter: only combine the patterns whose required literal text is in the line - 
+        patterns without such a literal are always tried
+    
+    Like ReMatcher the last match is stored per thread - or use matchResult / searchResult.
+    '''
+    maxCombinations = 256  # cached alternations of candidate patterns - further sets use the alternation of all patterns
+
+    def __init__(self, patterns, flags=0, prefilter=True):
+        self.patterns = list(patterns)
+        self.flags = flags
+        self.local = local()  # index, m and g of the last match in the current thread
+        self.regexes = [compiled(pattern, flags) for pattern in self.patterns]
+        self.separate = []  # (index, compiled regex, required literal) of patterns that are not combined
+        combined = []
+        for idx, pattern in enumerate(self.patterns):
+            if _backRef.search(pattern) or _globalFlags.match(pattern):
+                self.separate.append((idx, self.regexes[idx], _requiredLiteral(pattern, flags) if prefilter else None))
+            else:
+                combined.append(idx)
+        self.combined = tuple(combined)
+        self.combinations = {}  # tuple of pattern indices -> (alternation, pattern index -> (first, last) group)
+        if self.combined:
+            self._combination(self.combined)
+        self.literals = None  # (literal, indices of the patterns requiring it)
+        self.always = self.combined  # indices of the patterns without required literal
+        if prefilter:
+            byLiteral = {}
+            always = []
+            for idx in self.combined:
+                literal = _requiredLiteral(self.patterns[idx], flags)
+                if literal == None:
+                    always.append(idx)
+                else:
+                    byLiteral.setdefault(literal, []).append(idx)
+            self.literals = [(literal, tuple(indices)) for literal, indices in byLiteral.items()]
+            self.always = tuple(always)
+
+    def _combination(self, indices):
+        ''' the alternation of the given patterns - created once per set of candidate patterns '''
+        combination = self.combinations.get(indices)
+        if combination == None:
+            if len(self.combinations) >= self.maxCombinations:
+                # the other patterns cannot match either - they require a literal that is not in the line
+                return self.combinations[self.combined]
+            alternatives = []
+            groupRanges = {}
+            groupIdx = 0
+            for idx in indices:
+                # the pattern's named groups are turned into plain groups - names may be used in several patterns
+                alternatives.append('(?P<_p%d>%s)' % (idx, _namedGroup.sub('(', self.patterns[idx])))
+                groupRanges[idx] = (groupIdx + 2, groupIdx + 1 + self.regexes[idx].groups)
+                groupIdx += 1 + self.regexes[idx].groups
+            combination = self.combinations[indices] = (re.compile('|'.join(alternatives), self.flags), groupRanges)
+        return combination
+
+    def _candidates(self, chk):
+        ''' indices of the combined patterns that can match chk '''
+        if self.literals == None:
+            return self.always
+        found = [indices for literal, indices in self.literals if literal in chk]
+        if not found:
+            return self.always
+        if len(found) == 1 and not self.always:
+            return found[0]
+        return tuple(sorted(self.always + tuple(idx for indices in found for idx in indices)))
+
+    def _find(self, chk, method):
+        ''' returns (pattern index, match object, groups) of the first matching pattern '''
+        idx = len(self.patterns)
+        m = None
+        candidates = self._candidates(chk)
+        if candidates:
+            regex, groupRanges = self._combination(candidates)
+            m = getattr(regex, method)(chk)
+            if m:
+                idx = self._patternIndex(m, groupRanges)
+                first, last = groupRanges[idx]
+                groups = m.groups()[first - 1:last]
+                if method == 'search':
+                    # the alternation finds the leftmost match - a candidate with a lower index may match further right
+                    for earlier in candidates:
+                        if earlier >= idx:
+                            break
+                        found = self.regexes[earlier].search(chk)
+                        if found:
+                            idx, m, groups = earlier, found, found.groups()
+                            break
+        for sepIdx, regex, literal in self.separate:
+            if sepIdx > idx:
+                break
+            if literal == None or literal in chk:
+                sep = getattr(regex, method)(chk)
+                if sep:
+                    return sepIdx, sep, sep.groups()
+        if m:
+            return idx, m, groups
+        return -1, None, None
+
+    def _patternIndex(self, m, groupRanges):
+        if m.lastgroup != None and m.lastgroup.startswith('_p'):
+            return int(m.lastgroup[2:])
+        for idx in groupRanges:
+            if m.group('_p%d' % idx) != None:
+                return idx
+        return -1
+
+    def match(self, chk):
+        ''' matches the patterns at the start of chk - sets index and groups of the first matching pattern '''
+        self.local.index, self.local.m, self.local.g = self._find(chk, 'match')
+        return self.local.index >= 0
+
+    def search(self, chk):
+        ''' searches the patterns anywhere in chk - sets index and groups of the first matching pattern '''
+        self.local.index, self.local.m, self.local.g = self._find(chk, 'search')
+        return self.local.index >= 0
+
+    def matchResult(self, chk):
+        ''' match without storing the result - returns (pattern index, match object, groups) or None '''
+        result = self._find(chk, 'match')
+        return result if result[0] >= 0 else None
+
+    def searchResult(self, chk):
+        ''' search without storing the result - returns (pattern index, match object, groups) or None '''
+        result = self._find(chk, 'search')
+        return result if result[0] >= 0 else None
+
+    @property
+    def index(self):
+        ''' index of the last matching pattern of the current thread - -1 if nothing matched '''
+        return getattr(self.local, 'index', -1)
+
+    @property
+    def m(self):
+        return getattr(self.local, 'm', None)
+
+    def group(self, i):
+        ''' group of the last matching pattern - 0 is the complete match '''
+        return self.local.m.group(0) if i == 0 else self.local.g[i - 1]
+
+    def groups(self):
+        return getattr(self.local, 'g', None)
+
+    def copy(self):
+        cp = copy.copy(self)
+        cp.local = local()
+        return cp
+
+    def __getstate__(self):
+        ''' the matches of the threads are not copied / pickled (e.g. when passed to worker processes) '''
+        state = dict(self.__dict__)
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = local()
@@ -3,40 +3,449 @@ Created on 16.02.2020
 
 @author: Michael Schulte
 '''
+import os
+import pyexpat
 import xml.sax
+from xml.sax.xmlreader import AttributesImpl, Locator
+
+
+def _content(chunks):
+    ''' joins the text chunks of an element - the text before and after each child element is stripped and separated by a new line '''
+    if None not in chunks:
+        return ''.join(chunks).strip()
+    segments = []
+    start = 0
+    chunks = chunks + [None]
+    for idx, chunk in enumerate(chunks):
+        if chunk == None:
+            segment = ''.join(chunks[start:idx]).strip()
+            if segment:
+                segments.append(segment)
+            start = idx + 1
+    return '\n'.join(segments)
+
+
+class _PathPattern(object):
+    ''' Simple XPath like pattern:
+    /root/item/title : absolute path
+    item/title : path at any depth (same as //item/title)
+    * : any element name in a single step
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.anchored = path.startswith('/') and not path.startswith('//')
+        self.steps = tuple(step for step in path.strip('/').split('/') if step)
+
+    def matches(self, key):
+        if len(key) < len(self.steps) or (self.anchored and len(key) != len(self.steps)):
+            return False
+        for step, name in zip(self.steps, key[len(key) - len(self.steps):]):
+            if step != '*' and step != name:
+                return False
+        return True
+
+
+class _PathNode(object):
+    ''' Element path of the document - the visited paths form a tree, so the subscriptions are only matched once per path '''
+    __slots__ = ('name', 'key', 'parent', 'children', 'subscriptions')
+
+    def __init__(self, name=None, parent=None, subscriptions=()):
+        self.name = name
+        self.key = parent.key + (name,) if parent != None else ()  # element names starting with the root element
+        self.parent = parent
+        self.children = {}  # name -> _PathNode
+        self.subscriptions = subscriptions  # (pattern, callback) matching the path
+
+
+class _Locator(Locator):
+    ''' position of the expat parser for setDocumentLocator and SAXParseException '''
+    def __init__(self, parser, systemId):
+        self.parser = parser
+        self.systemId = systemId
+
+    def getColumnNumber(self):
+        return self.parser.ErrorColumnNumber
+
+    def getLineNumber(self):
+        return self.parser.ErrorLineNumber
+
+    def getSystemId(self):
+        return self.systemId
+
 
 class SaxHelper(xml.sax.handler.ContentHandler):
     '''
-    Helper for SAX content handler that adds the received characters
-    to currentContent and parses the file with the given filename.
-    
+    Helper for SAX content handler that collects the received characters
+    of the current element in currentContent and parses the file with the given filename.
+
     class MyHandler(SaxHelper):
         # handle events
-        
+        def endElement(self, name):
+            if name == 'title':
+                self.titles.append(self.currentContent)
+
     with MyHandler(filename) as handler:
         # get handler results
+
+    The filename can also be a compressed file, a file-like object or an iterable of chunks / lines 
+    (e.g. the output of ExecHelper.readLines) - see parse. Data arriving in pieces can be given with feed.
+
+    The events come directly from the expat parser - only the overridden event methods are called.
+    The text chunks are only joined when currentContent is read. The text before and after
+    a child element is separated by a new line - the text of the child itself is not part of the content.
+    
+    Instead of handling all events, callbacks can be subscribed for element paths:
+    
+    handler = SaxHelper(filename)
+    handler.subscribe('/catalog/book', lambda record: books.append(record))
+    with handler:
+        pass
+    
+    Each record is a dict with the attributes ('@id'), the text of the direct child elements ('title')
+    and the text of the element itself ('#text'). Outside of the subscribed elements no text is 
+    collected and the event methods of the subclass are not called.
+    :param max_content: maximum number of characters kept per element - the rest of the text is ignored
     '''
-    def __init__(self, filename, parent=None):
-        self.currentContent = ''
+    def __init__(self, filename, parent=None, max_content=None):
         self.filename = filename
         self.parent = parent
-    
+        self.maxContent = max_content
+        self.subscriptions = []  # (pattern, callback)
+        self.records = []  # records of subscriptions without callback
+        self.root = _PathNode()
+        self.parser = None  # expat parser of the current document
+        self.locator = None
+        self._reset()
+
+    def _reset(self):
+        self.node = self.root  # path of the current element
+        self.chunks = []  # text chunks of the current element - None separates the text before and after a child element
+        self.stack = []  # chunk lists of the enclosing elements
+        self.record = None  # record of the current element if it is subscribed
+        self.recordStack = []
+        self.length = 0  # number of characters of the current element - only counted with max_content
+        self.lengths = []
+
+    def subscribe(self, path, callback=None):
+        ''' Calls the callback with the record of each element matching the path.
+        :param path: '/root/item' (absolute), 'item/title' (at any depth), '*' matches any element name
+        :param callback: function receiving the record dict. Default: the record is appended to self.records
+        '''
+        self.subscriptions.append((_PathPattern(path), callback))
+        self.root = _PathNode()
+        return self
+
+    def _child(self, name):
+        parent = self.node
+        node = _PathNode(name, parent)
+        node.subscriptions = [(pattern, callback) for pattern, callback in self.subscriptions if pattern.matches(node.key)]
+        parent.children[name] = node
+        return node
+
+    def _deliver(self, subscriptions, record):
+        for pattern, callback in subscriptions:
+            if callback == None:
+                self.records.append((pattern.path, record))
+            else:
+                callback(record)
+
+    @property
+    def currentContent(self):
+        ''' the text of the current element '''
+        return _content(self.chunks) if self.chunks else ''
+
+    @currentContent.setter
+    def currentContent(self, content):
+        self.chunks = [content]
+        self.length = len(content)
+
+    @property
+    def path(self):
+        ''' names of the currently open elements starting with the root element '''
+        return list(self.node.key)
+
+    def _start(self, name, attrs):
+        node = self.node.children.get(name) or self._child(name)
+        self.node = node
+        chunks = self.chunks
+        if chunks and chunks[-1] != None:
+            chunks.append(None)
+        self.stack.append(chunks)
+        self.chunks = []
+        self.recordStack.append(self.record)
+        self.record = dict(('@' + k, v) for k, v in attrs.items()) if node.subscriptions else None
+        if self.maxContent != None:
+            self.lengths.append(self.length)
+            self.length = 0
+        if self.forwardStart:
+            self.startElement(name, AttributesImpl(attrs))
+
+    def _end(self, name):
+        # the content of the element is still available in endElement
+        if self.forwardEnd:
+            self.endElement(name)
+        node = self.node
+        record = self.record
+        parentRecord = self.recordStack.pop()
+        if record != None or parentRecord != None:
+            content = _content(self.chunks)
+            if record != None:
+                record['#text'] = content
+                self._deliver(node.subscriptions, record)
+            if parentRecord != None:
+                parentRecord[name] = content
+        self.node = node.parent
+        self.record = parentRecord
+        self.chunks = self.stack.pop()
+        if self.maxContent != None:
+            self.length = self.lengths.pop()
+        if self.chunks == None:
+            self._skip()
+
+    def _skip(self):
+        ''' outside of the subscribed elements only the path is followed - no text is collected and no events are forwarded '''
+        parser = self.parser
+        parser.StartElementHandler = self._skipStart
+        parser.EndElementHandler = self._skipEnd
+        parser.CharacterDataHandler = None
+        self.chunks = None
+
+    def _skipStart(self, name, attrs):
+        if (self.node.children.get(name) or self._child(name)).subscriptions:
+            parser = self.parser
+            parser.StartElementHandler = self._start
+            parser.EndElementHandler = self._end
+            parser.CharacterDataHandler = self.characters
+            self._start(name, attrs)
+        else:
+            self.node = self.node.children[name]
+
+    def _skipEnd(self, _name):
+        self.node = self.node.parent
+
     def characters(self, content):
-        if len(self.currentContent) > 0:
-            self.currentContent += '\n'
-        self.currentContent += content.strip()
-        
-    def startElement(self, name, attrs):
-        self.currentContent = ''
-        xml.sax.handler.ContentHandler.startElement(self, name, attrs)
+        if self.maxContent != None:
+            if self.length >= self.maxContent:
+                return
+            content = content[:self.maxContent - self.length]
+            self.length += len(content)
+        self.chunks.append(content)
 
-    def __enter__(self):
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(self)
-        parser.parse(self.filename)
+    def _parser(self):
+        if self.parser == None:
+            cls = type(self)
+            self.forwardStart = cls.startElement is not xml.sax.handler.ContentHandler.startElement
+            self.forwardEnd = cls.endElement is not xml.sax.handler.ContentHandler.endElement
+            parser = self.parser = pyexpat.ParserCreate()
+            parser.buffer_text = True
+            parser.ProcessingInstructionHandler = self.processingInstruction
+            self._reset()
+            if self.subscriptions:
+                self._skip()
+            else:
+                parser.StartElementHandler = self._start
+                parser.EndElementHandler = self._end
+                parser.CharacterDataHandler = self.characters
+            self.locator = _Locator(parser, os.fspath(self.filename) if isinstance(self.filename, (str, os.PathLike)) else None)
+            self.setDocumentLocator(self.locator)
+            self.startDocument()
+        return self.parser
+
+    def _run(self, parse, *args):
+        ''' calls the parse method of the expat parser - syntax errors are raised as SAXParseException '''
+        try:
+            parse(*args)
+        except pyexpat.ExpatError as ex:
+            self.parser = None
+            raise xml.sax.SAXParseException(pyexpat.ErrorString(ex.code), ex, self.locator)
+
+    def _endDocument(self):
+        self.parser = None
+        self.endDocument()
+
+    def feed(self, data):
+        ''' Parses the next chunk (bytes or str) of the document - e.g. while it is still received '''
+        self._run(self._parser().Parse, data, False)
         return self
-    
+
+    def finish(self):
+        ''' Ends the document given with feed - raises a SAXParseException if it is incomplete '''
+        if self.parser != None:
+            self._run(self.parser.Parse, b'', True)
+            self._endDocument()
+        return self
+
+    def drain(self):
+        ''' Returns the results collected so far and removes them from the handler.
+        Returns the records of the subscriptions without callback - subclasses can return their own results.
+        '''
+        records = self.records
+        self.records = []
+        return records
+
+    def iterFeed(self, source, chunk_size=65536):
+        ''' Generator feeding the source chunk by chunk - use drain between the chunks '''
+        for chunk in _chunks(source, chunk_size):
+            self.feed(chunk)
+            yield self
+        self.finish()
+
+    def parse(self, source=None, chunk_size=65536):
+        ''' Parses the complete source:
+        - file name or path (.gz, .bz2 and .xz files are decompressed while parsing)
+        - file-like object (e.g. a pipe or sys.stdin.buffer)
+        - bytes 
+        - iterable of bytes chunks or of str lines (e.g. ExecHelper.readLines)
+        Default: the file name given in the constructor
+        '''
+        if source == None:
+            source = self.filename
+        if isinstance(source, os.PathLike):
+            source = os.fspath(source)
+        if isinstance(source, str):
+            with _openSource(source) as f:
+                self._run(self._parser().ParseFile, f)
+            self._endDocument()
+        else:
+            for _ in self.iterFeed(source, chunk_size):
+                pass
+        return self
+
+    def __enter__(self):
+        return self.parse()
+
     def __exit__(self, _tp, exc_inst, tb):
         if exc_inst:
             raise exc_inst.with_traceback(tb)
-            
\ No newline at end of file
+
+
+def _openSource(filename):
+    ''' opens the file for binary reading - compressed files (.gz, .bz2, .xz) are decompressed while reading '''
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        import bz2
+        return bz2.open(filename, 'rb')
+    if filename.endswith('.xz'):
+        import lzma
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _chunks(source, chunk_size):
+    ''' yields the data chunks of a file name or path, file-like object, bytes or iterable of chunks / lines '''
+    if isinstance(source, os.PathLike):
+        source = os.fspath(source)
+    if isinstance(source, str):
+        with _openSource(source) as f:
+            for chunk in _chunks(f, chunk_size):
+                yield chunk
+    elif isinstance(source, (bytes, bytearray)):
+        yield source
+    elif hasattr(source, 'read'):
+        chunk = source.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = source.read(chunk_size)
+    else:
+        for item in source:
+            # strings are lines e.g. from ExecHelper.readLines - the line breaks were removed
+            yield item + '\n' if isinstance(item, str) else item
+
+
+def iterparse(source, paths, chunk_size=65536):
+    ''' Generator of the records of the elements matching the given paths (see SaxHelper.subscribe).
+    The records are yielded while the source is still read.
+
+    for path, record in iterparse(filename, ['/catalog/book', 'author']):
+        print(record['title'])
+
+    :param source: see SaxHelper.parse
+    :return: tuples of (subscribed path, record dict) in document order
+    '''
+    handler = SaxHelper(source)
+    for path in paths:
+        handler.subscribe(path)
+    for _ in handler.iterFeed(source, chunk_size):
+        for item in handler.drain():
+            yield item
+    for item in handler.drain():
+        yield item
+
+
+def _drain(handler):
+    return handler.drain()
+
+
+def _parseBatch(handlerClass, fileNames, extract, kwargs):
+    ''' executed in the worker process '''
+    results = []
+    for f in fileNames:
+        try:
+            handler = handlerClass(f, **kwargs)
+            handler.parse()
+            results.append((f, extract(handler), None))
+        except Exception as ex:
+            # the exception itself is not necessarily picklable
+            results.append((f, None, '%s: %s' % (type(ex).__name__, ex)))
+    return results
+
+
+def iterParseFiles(handlerClass, fileNames, extract=_drain, processes=None, files_per_task=8, **kwargs):
+    ''' Parses the files with a process pool and yields (filename, result, error) as soon as the files are parsed.
+    The order of the results is not defined. A failing file does not abort the others - its error is reported instead.
+
+    class TitleHandler(SaxHelper):
+        def __init__(self, filename):
+            SaxHelper.__init__(self, filename)
+            self.subscribe('title')
+
+    for f, records, error in iterParseFiles(TitleHandler, fileNames):
+        if error:
+            print("Failed to parse %s: %s" % (f, error))
+
+    :param handlerClass: module level SaxHelper subclass - instantiated with each file name and kwargs
+    :param extract: module level function creating the (picklable) result of the parsed handler. Default: handler.drain()
+    :param processes: number of worker processes. Default: number of CPUs
+    :param files_per_task: number of files parsed with one call of the worker process
+    '''
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    fileNames = list(fileNames)
+    pool = ProcessPoolExecutor(processes)
+    try:
+        futures = {}  # future -> file names of the task
+        for idx in range(0, len(fileNames), files_per_task):
+            chunk = fileNames[idx:idx + files_per_task]
+            futures[pool.submit(_parseBatch, handlerClass, chunk, extract, kwargs)] = chunk
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as ex:
+                # e.g. a result that cannot be pickled or a broken pool - reported for each file of the task
+                error = '%s: %s' % (type(ex).__name__, ex)
+                results = [(f, None, error) for f in futures[future]]
+            for result in results:
+                yield result
+    finally:
+        # also reached when the caller stops iterating - the files not yet started are not parsed
+        pool.shutdown(cancel_futures=True)
+
+
+def parseFiles(handlerClass, fileNames, merge, initial=None, extract=_drain, processes=None, files_per_task=8, **kwargs):
+    ''' Parses the files with a process pool (see iterParseFiles) and reduces the results.
+
+    titles, errors = parseFiles(TitleHandler, fileNames, lambda all, records: all + records, [])
+
+    :param merge: function(merged, result) returning the new merged result - called in this process
+    :param initial: start value of the merged result
+    :return: tuple of (merged result, dict of file name -> error)
+    '''
+    merged = initial
+    errors = {}
+    for f, result, error in iterParseFiles(handlerClass, fileNames, extract, processes, files_per_task, **kwargs):
+        if error != None:
+            errors[f] = error
+        else:
+            merged = merge(merged, result)
+    return merged, errors
@@ -3,10 +3,12 @@ Created on 16.02.2020
 
 @author: Michael Schulte
 '''
+import codecs
+from collections import namedtuple
 from difflib import SequenceMatcher
 import os
 
-from ExecHelper import readLines
+from ExecHelper import readLines, readRecords
 from ReMatcher import ReMatcher
 
 
@@ -27,10 +29,26 @@ class GitCmd:
     def execute(self):
         cmd = ["git"] + self.command
         return readLines(cmd, cwd=self.cwd)
+    def records(self):
+        ''' NUL-delimited output of the command (for -z options) '''
+        return readRecords(["git"] + self.command, cwd=self.cwd)
     def __iter__(self):
         return self.execute()
 
+class ChangedFile(namedtuple('ChangedFile', ['status', 'path', 'origPath'])):
+    ''' Entry of Git.status:
+    status: two letter status XY of index and work tree like in "git status -s" - '.' means unchanged
+            ('??' for untracked files)
+    path: full path of the file
+    origPath: full path of the rename or copy source - None otherwise
+    '''
+    __slots__ = ()
+
+
 class Git:
+    _statusCache = {} # (sandbox, untracked) -> (state of index and HEAD, list of ChangedFile)
+    _repoDirsCache = {} # sandbox -> (top level directory, git directory)
+
     @classmethod
     def git(cls, command, cwd):
         ''' 
@@ -39,26 +57,169 @@ class Git:
         return GitCmd(command, cwd)
     
     @classmethod
-    def changedFiles(cls, sandbox, extension = ""):
+    def _repoDirs(cls, sandbox):
+        ''' (top level directory, git directory) of the repository containing the sandbox - (None, None) if unknown.
+        The sandbox may be a sub directory, a work tree or a submodule.
+        '''
+        key = os.path.abspath(sandbox)
+        dirs = cls._repoDirsCache.get(key)
+        if dirs == None:
+            lines = [line.strip() for line in cls.git("rev-parse --show-toplevel --absolute-git-dir", sandbox)]
+            dirs = (lines[0], lines[1]) if len(lines) == 2 else (None, None)
+            if dirs[0] != None:
+                dirs = (os.path.normpath(dirs[0]), os.path.normpath(dirs[1]))
+                cls._repoDirsCache[key] = dirs
+        return dirs
+
+    @classmethod
+    def _indexState(cls, sandbox):
+        ''' state of the index and HEAD - changes with each commit, checkout or staging (None if unknown) '''
+        gitDir = cls._repoDirs(sandbox)[1]
+        if gitDir == None:
+            return None
+        try:
+            index = os.stat(os.path.join(gitDir, 'index'))
+            with open(os.path.join(gitDir, 'HEAD'), 'r') as f:
+                head = f.read().strip()
+            ref = None
+            if head.startswith('ref: '):
+                try:
+                    ref = os.stat(os.path.join(gitDir, head[5:])).st_mtime_ns
+                except OSError:
+                    ref = None # packed ref
+            return (index.st_mtime_ns, index.st_size, head, ref)
+        except OSError:
+            return None
+
+    @staticmethod
+    def parseStatus(records, topLevel):
+        ''' Parses the NUL-delimited records of "git status --porcelain=v2 -z" and yields ChangedFile entries.
+        The paths of porcelain v2 are relative to the top level directory of the repository.
+        '''
+        def fullPath(path):
+            return os.path.join(topLevel, path.replace('/', os.path.sep))
+
+        records = iter(records)
+        for record in records:
+            kind = record[:1]
+            if kind == '1':
+                fields = record.split(' ', 8)
+                yield ChangedFile(fields[1], fullPath(fields[8]), None)
+            elif kind == '2':
+                fields = record.split(' ', 9)
+                yield ChangedFile(fields[1], fullPath(fields[9]), fullPath(next(records)))
+            elif kind == 'u':
+                fields = record.split(' ', 10)
+                yield ChangedFile(fields[1], fullPath(fields[10]), None)
+            elif kind == '?':
+                yield ChangedFile('??', fullPath(record[2:]), None)
+            # '#' headers and ignored files ('!') are skipped
+
+    @classmethod
+    def status(cls, sandbox, untracked=False, cache=False):
+        ''' 
+        Get the status entries (ChangedFile) of the repository containing the given sandbox directory
+        
+        :param sandbox: sandbox directory (or a sub directory of it)
+        :param untracked: also return the untracked files
+        :param cache: return the result of the last call if the index and HEAD did not change since.
+            Changes of the work tree that are not staged are not detected - use it within one tool run only.
+        '''
+        key = (os.path.abspath(sandbox), untracked)
+        state = cls._indexState(sandbox) if cache else None
+        if state != None:
+            cached = cls._statusCache.get(key)
+            if cached != None and cached[0] == state:
+                return list(cached[1])
+        topLevel = cls._repoDirs(sandbox)[0] or sandbox
+        cmd = cls.git(["status", "--porcelain=v2", "-z", "-unormal" if untracked else "-uno"], sandbox)
+        entries = list(cls.parseStatus(cmd.records(), topLevel))
+        if state != None:
+            # git status may refresh the index itself
+            cls._statusCache[key] = (cls._indexState(sandbox), entries)
+        return entries
+    
+    @classmethod
+    def changedFiles(cls, sandbox, extension = "", cache=False):
         ''' 
         Get all changed files of given sandbox directory
         
         :param sandbox: sandbox directory 
         :param extension: file extension. Default is empty (all file types are returned). 
+        :param cache: see status
         :return: all changed files of the given extension 
         '''
-        for line in cls.git("status -s -uno", sandbox):
-            line = line.strip()
-            if (line[1] == 'M' or (line[0] == 'M') or (line[0] == 'A')) and (line.endswith(extension)):
-                idx = line.find(' -> ')
-                if idx != -1:
-                    yield os.path.join(sandbox, line[idx+4:]).replace('/', os.path.sep)
-                else:
-                    idx = line.find(' ')
-                    yield os.path.join(sandbox, line[idx+1:].strip().replace('/', os.path.sep)) 
+        for entry in cls.status(sandbox, cache=cache):
+            if (entry.status[1] == 'M' or entry.status[0] in 'MA') and entry.path.endswith(extension):
+                yield entry.path
+
+    @staticmethod
+    def _pairGreedy(linesLonger, linesShorter):
+        ''' For each line of linesShorter the index of the best matching line in linesLonger - in the same order.
+        This is a greedy algorithm that does not find the perfect solution 
+        but the best solution for the first item, then the best for the second and so on.
+        '''
+        minLen = len(linesShorter)
+        maxLen = len(linesLonger)
+        matcher = SequenceMatcher(None)
+        bestMatches = []
+        bestIdx = -1
+        for shortIdx in range(minLen):
+            # the short line is seq2 - its preprocessing is done once for all candidates
+            matcher.set_seq2(linesShorter[shortIdx][1])
+            bestRatio = 0
+            # idx is restricted to already matched items and a minimum of minLen items that have to be matched.
+            first = bestIdx + 1
+            bestIdx = first
+            for idx in range(first, maxLen - (minLen - shortIdx) + 1):
+                matcher.set_seq1(linesLonger[idx][1])
+                # the cheap upper bounds skip candidates that cannot be better
+                if matcher.real_quick_ratio() <= bestRatio or matcher.quick_ratio() <= bestRatio:
+                    continue
+                ratio = matcher.ratio()
+                if ratio > bestRatio:
+                    bestRatio = ratio
+                    bestIdx = idx
+            bestMatches.append(bestIdx)
+        return bestMatches
+
+    @staticmethod
+    def _pairOptimal(linesLonger, linesShorter):
+        ''' Same as _pairGreedy - but maximizes the sum of the ratios of all pairs (keeping the order) '''
+        minLen = len(linesShorter)
+        slack = len(linesLonger) - minLen  # number of lines that stay unpaired
+        matcher = SequenceMatcher(None)
+        # prevMax[k]: best sum pairing the first i short lines with the last one paired to a long line <= i-1+k
+        prevMax = [0.0] * (slack + 1)
+        choices = []  # per short line: for each k the k of the best pairing up to long line i+k
+        for i in range(minLen):
+            matcher.set_seq2(linesShorter[i][1])
+            rowMax = []
+            rowArg = []
+            curMax = -1.0
+            curArg = 0
+            for k in range(slack + 1):
+                prev = prevMax[k]
+                matcher.set_seq1(linesLonger[i + k][1])
+                # only the running maximum of the row is used - the cheap upper bounds skip the other candidates
+                if prev + matcher.real_quick_ratio() > curMax and prev + matcher.quick_ratio() > curMax:
+                    value = prev + matcher.ratio()
+                    if value > curMax:
+                        curMax = value
+                        curArg = k
+                rowMax.append(curMax)
+                rowArg.append(curArg)
+            choices.append(rowArg)
+            prevMax = rowMax
+        bestMatches = [0] * minLen
+        k = slack
+        for i in range(minLen - 1, -1, -1):
+            k = choices[i][k]
+            bestMatches[i] = i + k
+        return bestMatches
 
     @classmethod
-    def mergeDiff(cls, linesRemoved, linesAdded, changesOnly=False):
+    def mergeDiff(cls, linesRemoved, linesAdded, changesOnly=False, optimal=False):
         '''
         Combines the added lines and removed lines.
          
@@ -70,6 +231,7 @@ class Git:
         :param linesRemoved: list of ((lineNo, content)) for each removed line in the diff
         :param linesAdded: list of ((lineNo, content)) for each added line in the diff
         :param changesOnly: if True only the matching pairs of changed lines (removed + added) are returned  
+        :param optimal: find the pairs with the best overall similarity instead of the (faster) greedy pairing
         ''' 
         minLen = min(len(linesRemoved), len(linesAdded))
         maxLen = max(len(linesRemoved), len(linesAdded))
@@ -78,33 +240,21 @@ class Git:
             moreAdded = len(linesAdded) > len(linesRemoved)
             (linesLonger, linesShorter) = (linesAdded, linesRemoved) if moreAdded else (linesRemoved, linesAdded)
 
-            bestMatches = []
-            shortIdx = 0
-            bestIdx = -1
-            while shortIdx < minLen:
-                bestRatio = 0
-                # idx is restricted to already matched items and a minimum of minLen items that have to be matched.
-                for idx in range(bestIdx+1, maxLen - (minLen - shortIdx) + 1):
-                    # try to find the best matching lines 
-                    # - this is a greedy algorithm finding that does not find the perfect solution 
-                    # but the best solution for the first item, then the best for the second and so on. 
-                    ratio = SequenceMatcher(None, linesLonger[idx][1], linesShorter[shortIdx][1]).ratio()
-                    if ratio > bestRatio:
-                        bestRatio = ratio
-                        bestIdx = idx
-                bestMatches.append(bestIdx)
-                shortIdx += 1
+            bestMatches = (cls._pairOptimal if optimal else cls._pairGreedy)(linesLonger, linesShorter)
+            paired = [False] * maxLen
+            for idx in bestMatches:
+                paired[idx] = True
 
             shortCnt = 0
             for idx in range(maxLen):
                 if moreAdded:
-                    if idx in bestMatches:
+                    if paired[idx]:
                         yield((linesRemoved[shortCnt], linesAdded[bestMatches[shortCnt]]))
                         shortCnt += 1
                     elif not changesOnly:
                         yield((None, linesAdded[idx]))
                 else:
-                    if idx in bestMatches:
+                    if paired[idx]:
                         yield((linesRemoved[bestMatches[shortCnt]], linesAdded[shortCnt]))
                         shortCnt += 1
                     elif not changesOnly:
@@ -116,7 +266,8 @@ class Git:
         del linesRemoved[:]
     
     @classmethod
-    def diff(cls, f, changesOnly=False):
+    def diffLines(cls, lines, changesOnly=False):
+        ''' Parses the hunks of the (-U0) diff output lines of a single file and yields the merged changes (see mergeDiff) '''
         lineNoRemove = 0
         lineNoAdd = 0
         patPlusMinus = ReMatcher("@@.*\\-([0-9]+)[ ,]+.*\\+([0-9]+)[ ,]+.*")
@@ -124,7 +275,7 @@ class Git:
         linesAdded = []
         started = False
                     
-        for line in cls.git("diff", os.path.dirname(f)).extend(["-U0", "-w", "--patience"]).add(f):
+        for line in lines:
             if line.startswith("@@") and patPlusMinus.match(line):
                 started = True
                 # new section: return the previous merged results
@@ -144,6 +295,113 @@ class Git:
         # end of last section: return the last results
         for item in cls.mergeDiff(linesRemoved, linesAdded, changesOnly):
             yield item
+
+    @classmethod
+    def diff(cls, f, changesOnly=False):
+        return cls.diffLines(cls.git("diff", os.path.dirname(f)).extend(["-U0", "-w", "--patience"]).add(f), changesOnly)
+
+    @staticmethod
+    def _diffPath(line):
+        ''' file name of a "--- a/name" or "+++ b/name" line - None for /dev/null '''
+        name = line[4:]
+        if name.startswith('"') and name.endswith('"'):
+            # C style quoting - non-ASCII characters are octal escapes of their UTF-8 bytes
+            name = codecs.escape_decode(name[1:-1].encode('utf-8'))[0].decode('utf-8')
+        if name == '/dev/null':
+            return None
+        return name[2:]
+
+    @classmethod
+    def splitDiff(cls, lines):
+        ''' Splits the output of a diff over several files - yields (file name relative to the repository, lines) for each file '''
+        name = None
+        fileLines = None
+        inHeader = False
+        for line in lines:
+            if line.startswith('diff --git '):
+                if name != None:
+                    yield name, fileLines
+                name = None
+                fileLines = []
+                inHeader = True
+            elif fileLines == None:
+                continue
+            elif inHeader and line.startswith('--- '):
+                name = cls._diffPath(line)
+            elif inHeader and line.startswith('+++ '):
+                name = cls._diffPath(line) or name
+            elif not inHeader or line.startswith('@@'):
+                inHeader = False
+                fileLines.append(line)
+        if name != None:
+            yield name, fileLines
+
+    @classmethod
+    def diffAll(cls, files, changesOnly=False, processes=None, maxCmdLen=8000):
+        ''' Diffs many files with one git call (per maxCmdLen characters of file names) and yields (file, changes) 
+        as soon as the changes of the file are merged. The order of the files is not defined.
+        The hunks of the files are merged in a process pool while git still writes the diff.
+        
+        for f, changes in Git.diffAll(Git.changedFiles(sandbox)):
+            for removed, added in changes:
+                # ...
+        
+        :param files: files of the same git repository
+        :param processes: number of worker processes. 0: merge the hunks in this process
+        :return: tuples of (file name as given in files, list of changes as returned by diff) - unchanged files have no changes
+        '''
+        files = list(files)
+        if not files:
+            return
+        cwd = os.path.dirname(os.path.abspath(files[0]))
+        top = next(iter(cls.git("rev-parse --show-toplevel", cwd))).strip()
+        byPath = dict((os.path.normcase(os.path.abspath(f)), f) for f in files)
+        diffed = set()
+
+        def output():
+            chunk = []
+            chunkLen = 0
+            for f in files + [None]:
+                arg = os.path.abspath(f) if f != None else None  # the length of the path as passed to git
+                if arg == None or (chunk and chunkLen + len(arg) > maxCmdLen):
+                    cmd = cls.git("-c core.quotePath=false diff -U0 -w --patience --no-color --", top).extend(chunk)
+                    for name, lines in cls.splitDiff(cmd):
+                        path = os.path.join(top, name.replace('/', os.path.sep))
+                        f = byPath.get(os.path.normcase(os.path.abspath(path)), path)
+                        diffed.add(f)
+                        yield f, lines
+                    chunk = []
+                    chunkLen = 0
+                if arg != None:
+                    chunk.append(arg)
+                    chunkLen += len(arg) + 1
+
+        if processes == 0:
+            for f, lines in output():
+                yield _diffFile(f, lines, changesOnly)
+        else:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(processes) as pool:
+                pending = set()
+                for f, lines in output():
+                    pending.add(pool.submit(_diffFile, f, lines, changesOnly))
+                    done = [future for future in pending if future.done()]
+                    for future in done:
+                        pending.remove(future)
+                        yield future.result()
+                for future in as_completed(pending):
+                    yield future.result()
+        for f in files:
+            if f not in diffed:
+                # e.g. unchanged, untracked or only whitespace changes
+                diffed.add(f)
+                yield f, []
+
+
+def _diffFile(f, lines, changesOnly):
+    ''' executed in the worker process '''
+    return f, list(Git.diffLines(lines, changesOnly))
+
         
 if __name__ == '__main__':
     for item in Git.mergeDiff(linesRemoved = [(1, "first"), (2, "third")], linesAdded = [(1, "First"), (2, "Second"), (3, "Third")]):
@@ -4,43 +4,210 @@ Created on 16.02.2020
 @author: Michael Schulte
 '''
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
+import json
 import os
-from zipfile import ZipFile
+import sys
+import zipfile
+from zipfile import ZipFile, ZipInfo
 
 from git.GitHelper import Git
 
 
+METHODS = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED,
+           'bzip2': zipfile.ZIP_BZIP2, 'lzma': zipfile.ZIP_LZMA}
+
+
+# The private zipfile API needed to write entries that were compressed in other threads is only used by
+# compressFile and writeCompressed - canWriteCompressed checks that it is still available.
+_ZIP_INTERNALS = ('_lock', '_writecheck', '_didModify', 'fp', 'filelist', 'NameToInfo', 'start_dir')
+
+
+def canWriteCompressed(myzip):
+    ''' True if compressFile and writeCompressed work with this zipfile version - otherwise use ZipFile.write '''
+    return hasattr(zipfile, '_get_compressor') and all(hasattr(myzip, name) for name in _ZIP_INTERNALS)
+
+
+def compressFile(f, compression, level=None):
+    ''' Reads and compresses the file (executed in a worker thread - zlib, bz2 and lzma release the GIL).
+    :return: tuple of (ZipInfo with CRC and sizes, compressed data)
+    '''
+    zinfo = ZipInfo.from_file(f)
+    zinfo.compress_type = compression
+    with open(f, 'rb') as fh:
+        data = fh.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zipfile.crc32(data)
+    compressor = zipfile._get_compressor(compression, level)
+    if compressor != None:
+        data = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def writeCompressed(myzip, zinfo, data):
+    ''' Writes an already compressed entry into the zip file - analog to ZipFile.writestr without compressing.
+    Works also on streams that are not seekable as the sizes and CRC are known in advance.
+    '''
+    if zinfo.compress_type == zipfile.ZIP_LZMA:
+        zinfo.flag_bits |= 0x02  # the LZMA stream has an end marker - set like ZipFile.write does
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with myzip._lock:
+        myzip._writecheck(zinfo)
+        myzip._didModify = True
+        zinfo.header_offset = myzip.fp.tell()
+        myzip.fp.write(zinfo.FileHeader(zip64))
+        myzip.fp.write(data)
+        myzip.filelist.append(zinfo)
+        myzip.NameToInfo[zinfo.filename] = zinfo
+        myzip.start_dir = myzip.fp.tell()
+
+
+def hashFile(f, chunk_size=1024 * 1024):
+    ''' SHA-1 of the file content (hashlib releases the GIL - so several files can be hashed in parallel) '''
+    h = hashlib.sha1()
+    with open(f, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 class ZipChangedFiles(object):
+    ''' Zips the changed files of a git sandbox.
+    In incremental mode a manifest of the zipped files (size, modification time, content hash and archive)
+    is kept - each snapshot only contains the files whose content changed since the previous snapshot.
+    '''
 
     def __init__(self, args):
         self.args = args
-    
+        self.compression = METHODS[getattr(args, 'method', None) or 'deflated']
+        self.level = getattr(args, 'level', None)
+        self.threads = getattr(args, 'threads', None) or os.cpu_count() or 1
+        # files read and compressed in parallel hold at most maxInMemory bytes of content - larger files are compressed by the zip file itself
+        self.maxInMemory = getattr(args, 'maxinmemory', None) or 64 * 1024 * 1024
+        self.log = sys.stderr if args.outputfile == '-' else sys.stdout
+        self.incremental = getattr(args, 'incremental', False)
+        self.manifestFile = getattr(args, 'manifest', None) or (args.projectpath.rstrip('/\\') + '_manifest.json')
+
+    def _loadManifest(self):
+        try:
+            with open(self.manifestFile, 'r') as f:
+                return json.load(f).get('files', {})
+        except (IOError, ValueError):
+            return {}
+
+    def _saveManifest(self, files):
+        tmpfile = self.manifestFile + '~'
+        with open(tmpfile, 'w') as f:
+            json.dump({'files': files}, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.manifestFile)
+
+    def snapshotChanges(self, files, manifest, archive):
+        ''' Compares the files with the manifest of the previous snapshot.
+        Files with the same size and modification time are not read - the others are hashed in parallel.
+        :return: tuple of (files with changed content, the new manifest)
+        '''
+        newManifest = {}
+        candidates = []
+        for f in files:
+            st = os.stat(f)
+            entry = manifest.get(f)
+            if entry != None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                newManifest[f] = entry
+            else:
+                candidates.append((f, st))
+        changed = []
+        with ThreadPoolExecutor(self.threads) as pool:
+            for (f, st), sha1 in zip(candidates, pool.map(hashFile, [f for f, _ in candidates])):
+                entry = manifest.get(f)
+                if entry == None or entry['sha1'] != sha1:
+                    entry = {'sha1': sha1, 'archive': archive}
+                    changed.append(f)
+                else:
+                    entry = dict(entry) # only touched
+                entry['size'] = st.st_size
+                entry['mtime_ns'] = st.st_mtime_ns
+                newManifest[f] = entry
+        return changed, newManifest
+
+    def _files(self):
+        for f in Git.changedFiles(self.args.projectpath):
+            if not os.path.basename(f).startswith('.'):  # ignore .cproject, etc
+                yield f
+
     def performZip(self):
         zipfile = self.args.outputfile
         if zipfile == None:
             dt = datetime.now()
             zipfile = self.args.projectpath + '_' + dt.strftime("%Y%m%d_%H%M%S.zip")
         if self.args.verbose:
-            print("creating zip file " + zipfile)
-        with ZipFile(zipfile, 'w') as myzip:
-            for f in Git.changedFiles(self.args.projectpath):
-                if self.args.verbose:
-                    print("adding " + f)
-                if not os.path.basename(f).startswith('.'):  # ignore .cproject, etc
-                    myzip.write(f)                
+            self.log.write("creating zip file " + zipfile + "\n")
+        files = self._files()
+        if self.incremental:
+            files, manifest = self.snapshotChanges(list(files), self._loadManifest(), os.path.basename(zipfile))
+            if not files:
+                self.log.write("no changes since the last snapshot\n")
+                self._saveManifest(manifest)
+                return
+        target = sys.stdout.buffer if zipfile == '-' else zipfile
+        with ZipFile(target, 'w', compression=self.compression, compresslevel=self.level) as myzip:
+            self.writeFiles(myzip, files)
+        if self.incremental:
+            # the manifest is only written after the archive is complete
+            self._saveManifest(manifest)
+
+    def writeFiles(self, myzip, files):
+        ''' Compresses the files in parallel threads and writes them in the given order into the zip file '''
+        if not canWriteCompressed(myzip):
+            for f in files:
+                self._writeEntry(myzip, f, None)
+            return
+        with ThreadPoolExecutor(self.threads) as pool:
+            pending = deque()  # (file, future or None for large files, size) in the order of the files
+            buffered = 0  # size of the files read or compressed and not yet written
+            for f in files:
+                size = os.path.getsize(f)
+                if size > self.maxInMemory:
+                    pending.append((f, None, 0))
+                    continue
+                # keep the content in memory bounded - the oldest files are written first
+                while pending and buffered + size > self.maxInMemory:
+                    done, future, doneSize = pending.popleft()
+                    self._writeEntry(myzip, done, future)
+                    buffered -= doneSize
+                pending.append((f, pool.submit(compressFile, f, self.compression, self.level), size))
+                buffered += size
+            for f, future, _ in pending:
+                self._writeEntry(myzip, f, future)
+
+    def _writeEntry(self, myzip, f, future):
+        if self.args.verbose:
+            self.log.write("adding " + f + "\n")
+        if future == None:
+            myzip.write(f)
+        else:
+            writeCompressed(myzip, *future.result())
 
 
 def main():
     import argparse
-    
+
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description='Add changed and added files in git repo to a zip file')
 
     parser.add_argument('-v', '--verbose', help='Print additional info', required=False, default=False, action='store_true')
     parser.add_argument('-p', '--projectpath', help='local project path', required=True)
-    parser.add_argument('-o', '--outputfile', help='output zip file', required=False, default=None)
-    
+    parser.add_argument('-o', '--outputfile', help='output zip file - "-" writes the zip file to stdout', required=False, default=None)
+    parser.add_argument('-m', '--method', help='compression method', required=False, default='deflated', choices=sorted(METHODS))
+    parser.add_argument('-l', '--level', help='compression level (deflated: 0-9, bzip2: 1-9)', required=False, default=None, type=int)
+    parser.add_argument('-i', '--incremental', help='only add files whose content changed since the last snapshot', required=False, default=False, action='store_true')
+    parser.add_argument('--manifest', help='manifest of the incremental snapshots. Default: <projectpath>_manifest.json', required=False, default=None)
+    parser.add_argument('-t', '--threads', help='number of compression threads. Default: number of CPUs', required=False, default=None, type=int)
+    parser.add_argument('--maxinmemory', help='maximum bytes of file content compressed in memory at once - larger files are compressed while writing', required=False, default=64 * 1024 * 1024, type=int)
+
     ZipChangedFiles(parser.parse_args()).performZip()
 
 